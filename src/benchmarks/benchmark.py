@@ -0,0 +1,295 @@
+# pylint: disable=import-error,wrong-import-position
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import json
+import multiprocessing
+import platform
+import sys
+import tempfile
+import time as clock
+
+import click
+import numpy
+import soundfile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'tests'))
+
+from test_utils import time, wave
+
+from remucs import RemucsOptions
+from remucs import analysis, profiling, tuning
+from remucs.pitch import shiftpitch_blocks
+from remucs.synthesis import synthesize
+from remucs.utils import semitone
+
+SR    = 44100
+STEMS = RemucsOptions().stems
+
+# The results are only comparable on the same machine, so the baseline is stored per host and not committed.
+# Run `python src/benchmarks/benchmark.py --save` once on a clean checkout to regenerate it.
+BASELINE = Path(__file__).resolve().parent / f'baseline-{platform.node() or "local"}.json'
+
+
+class FakeSeparator:
+
+    # Mimics the demucs.api.Separator by returning fixed fractions of the input as stems,
+    # so that everything but the separation itself can be measured without the model.
+
+    samplerate     = SR
+    audio_channels = 2
+
+    def update_parameter(self, **kwargs):
+        pass
+
+    def _load_audio(self, path):
+        import torch  # pylint: disable=import-outside-toplevel
+        return torch.from_numpy(soundfile.read(path, dtype='float32', always_2d=True)[0].T.copy())
+
+    def separate_tensor(self, wav, sr=None):  # pylint: disable=unused-argument
+        return wav, {stem: wav * weight for stem, weight in zip(STEMS, [0.4, 0.1, 0.3, 0.2])}
+
+
+def fake(opts: RemucsOptions) -> bool:
+
+    if analysis.backend() != 'demucs.api':
+        return False
+
+    # inject the fake separator into the shared separator instances
+    analysis.SEPARATORS[(opts.model, opts.device)] = FakeSeparator()
+
+    return True
+
+
+def generate(root: Path, seconds: float):
+
+    t = time(seconds, SR)
+
+    rng = numpy.random.default_rng(0)
+
+    # a decaying noise burst every half a second
+    drums = rng.uniform(-1, +1, (len(t), 2)) * numpy.exp(-20 * (t % 0.5))[..., None]
+
+    stems = {
+        'bass':   wave([55, 82.5], t),
+        'drums':  drums,
+        'other':  (wave([440, 660], t) + wave([550, 880], t)) / 2,
+        'vocals': wave([330, 495], t * (1 + 1e-3 * numpy.sin(2 * numpy.pi * 5 * t))),
+    }
+
+    (root / 'stems' / 'htdemucs').mkdir(parents=True)
+
+    for stem, samples in stems.items():
+        soundfile.write(root / 'stems' / 'htdemucs' / f'{stem}.wav', 0.2 * samples, SR)
+
+    soundfile.write(root / 'input.wav', 0.2 * numpy.sum(list(stems.values()), axis=0), SR)
+
+    # prepare the stem cache for the cache hit case
+    (root / 'data').mkdir()
+
+    opts = RemucsOptions()
+
+    if fake(opts):
+        analysis.analyze(root / 'input.wav', root / 'data', opts)
+
+
+def bench_synthesize(root: Path, seconds: float):  # pylint: disable=unused-argument
+
+    synthesize(root / 'output.wav', root / 'stems', RemucsOptions())
+
+
+def bench_synthesize_pitch(root: Path, seconds: float):  # pylint: disable=unused-argument
+
+    synthesize(root / 'output.wav', root / 'stems', RemucsOptions(pitch=semitone('+2')))
+
+
+def bench_shiftpitch(root: Path, seconds: float):  # pylint: disable=unused-argument
+
+    opts = RemucsOptions()
+
+    with soundfile.SoundFile(root / 'stems' / 'htdemucs' / 'other.wav') as file:
+
+        blocks = shiftpitch_blocks(file.blocks(opts.blocksize, always_2d=True),
+                                   blocksize=opts.blocksize,
+                                   samplerate=SR,
+                                   factor=semitone('+2'),
+                                   quefrency=0,
+                                   framesize=opts.framesize,
+                                   hopsize=opts.hopsize)
+
+        for _ in blocks:
+            pass
+
+
+def bench_tuning(root: Path, seconds: float):  # pylint: disable=unused-argument
+
+    tuning.analyze(root / 'stems' / 'htdemucs' / 'other.wav', RemucsOptions())
+
+
+def bench_findpeaks(root: Path, seconds: float):  # pylint: disable=unused-argument
+
+    # one batch of QDFT magnitudes per second of audio at the tuning sample rate
+    x = numpy.abs(numpy.random.default_rng(0).standard_normal((8000, 256)))
+
+    indices = numpy.empty((len(x), 3), int)
+    values  = numpy.empty((len(x), 3), float)
+
+    for _ in range(int(seconds)):
+        tuning.findpeaks(x, 3, indices, values)
+
+
+def bench_analyze_hit(root: Path, seconds: float):  # pylint: disable=unused-argument
+
+    opts = RemucsOptions()
+
+    if not fake(opts):
+        raise ModuleNotFoundError('demucs.api')
+
+    analysis.analyze(root / 'input.wav', root / 'data', opts)
+
+
+def bench_analyze_miss(root: Path, seconds: float):  # pylint: disable=unused-argument
+
+    opts = RemucsOptions()
+
+    if not fake(opts):
+        raise ModuleNotFoundError('demucs.api')
+
+    with tempfile.TemporaryDirectory(dir=root) as data:
+        analysis.analyze(root / 'input.wav', Path(data), opts)
+
+
+CASES: Dict[str, Callable[[Path, float], None]] = {
+    'synthesize':       bench_synthesize,
+    'synthesize-pitch': bench_synthesize_pitch,
+    'shiftpitch':       bench_shiftpitch,
+    'tuning':           bench_tuning,
+    'findpeaks':        bench_findpeaks,
+    'analyze-hit':      bench_analyze_hit,
+    'analyze-miss':     bench_analyze_miss,
+}
+
+
+def measure(case: str, root: Path, seconds: float, repeat: int) -> Dict[str, float]:
+
+    # Runs in a separate process, so that the peak memory usage only covers the specified case,
+    # whose first repetition also includes lazy imports and jit compilation.
+    times = []
+
+    for _ in range(repeat):
+
+        start = clock.perf_counter()
+        CASES[case](root, seconds)
+        times.append(clock.perf_counter() - start)
+
+    wall = min(times)
+
+    return {'wall': wall, 'rss': profiling.maxrss() / (1 << 20), 'throughput': seconds / wall}
+
+
+def machine() -> Dict[str, Any]:
+
+    return {
+        'python':    platform.python_version(),
+        'platform':  platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus':      multiprocessing.cpu_count(),
+    }
+
+
+@click.command(context_settings={'help_option_names': ['-h', '--help']})
+@click.option('-c', '--case', 'cases',
+                               multiple=True,
+                               type=click.Choice(list(CASES)),
+                               help='Benchmark case to run, all by default.')
+@click.option('-s', '--seconds',
+                               multiple=True,
+                               type=click.FloatRange(min=1),
+                               help='Synthetic track length in seconds, 10 and 30 by default.')
+@click.option('-r', '--repeat',
+                               default=3,
+                               show_default=True,
+                               type=click.IntRange(min=1),
+                               help='Number of repetitions, of which the fastest one counts.')
+@click.option('-b', '--baseline',
+                               default=BASELINE,
+                               show_default=True,
+                               type=click.Path(dir_okay=False, path_type=Path),
+                               help='Stored baseline results to compare with.')
+@click.option('-t', '--tolerance',
+                               default=0.25,
+                               show_default=True,
+                               type=click.FloatRange(min=0),
+                               help='Relative wall time or peak memory increase to be reported as regression.')
+@click.option('--save',
+                               default=False,
+                               is_flag=True,
+                               help='Store the results as new baseline instead of comparing them.')
+def main(cases: List[str], seconds: List[float], repeat: int, baseline: Path, tolerance: float, save: bool):
+
+    cases   = list(cases) or list(CASES)
+    seconds = list(seconds) or [10, 30]
+
+    stored  = json.loads(baseline.read_text(encoding='utf-8')) if baseline.is_file() else {'results': {}}
+    results = {}
+    regressions = []
+
+    context = multiprocessing.get_context('spawn')
+
+    if stored.get('machine', machine()) != machine():
+        click.echo(f'Comparing with the baseline of a different machine {stored["machine"]}')
+
+    click.echo(f'{"case":<24} {"wall [s]":>10} {"rss [MB]":>10} {"audio/wall":>10} {"baseline":>10}')
+
+    for length in seconds:
+
+        with tempfile.TemporaryDirectory() as root:
+
+            generate(Path(root), length)
+
+            for case in cases:
+
+                name = f'{case}@{length:g}s'
+
+                with context.Pool(1) as pool:
+                    try:
+                        result = pool.apply(measure, (case, Path(root), length, repeat))
+                    except ModuleNotFoundError as error:
+                        click.echo(f'{name:<24} skipped without {error}')
+                        continue
+
+                results[name] = result
+
+                ratio = ''
+
+                if name in stored['results']:
+
+                    base  = stored['results'][name]
+                    ratio = f'{result["wall"] / base["wall"]:9.2f}x'
+
+                    if result['wall'] > base['wall'] * (1 + tolerance) or \
+                       result['rss'] > base['rss'] * (1 + tolerance):
+                        regressions.append(name)
+                        ratio += ' !'
+
+                click.echo(f'{name:<24} {result["wall"]:10.3f} {result["rss"]:10.1f} {result["throughput"]:10.1f} {ratio:>10}')
+
+    if save:
+
+        stored = {'machine': machine(), 'results': {**stored['results'], **results}}
+        baseline.write_text(json.dumps(stored, indent=2), encoding='utf-8')
+
+        click.echo(f'Saved {baseline.resolve()}')
+
+        return
+
+    if regressions:
+
+        raise click.ClickException(
+            f'Found {len(regressions)} regressions compared to {baseline.resolve()}: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+
+    main()  # pylint: disable=no-value-for-parameter
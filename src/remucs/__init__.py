@@ -2,7 +2,8 @@ import importlib.metadata
 
 __version__ = importlib.metadata.version('remucs')
 
+from remucs.batch import batch
 from remucs.remucs import remucs
 from remucs.options import RemucsOptions
 
-__all__ = ['remucs', 'RemucsOptions']
+__all__ = ['batch', 'remucs', 'RemucsOptions']
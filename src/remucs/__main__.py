@@ -1,19 +1,78 @@
+from typing import Any, Dict
+
+import datetime
 import importlib.metadata
 import pathlib
 import traceback
 
 import click
 
+from remucs import cache, profiling
+from remucs.batch import batch
 from remucs.options import RemucsOptions
-from remucs.remucs import remucs
-from remucs.utils import cent, semitone
+from remucs.server import serve, submit
+from remucs.utils import bytesize, cent, semitone
 
 STEMS   = RemucsOptions().stems
 MODELS  = RemucsOptions().models
+REMUCS  = RemucsOptions().remucs
 VERSION = importlib.metadata.version('remucs')
 
 
-@click.command(
+class RemucsGroup(click.Group):
+
+    # Dispatches to the default remix command unless the first argument is a known subcommand
+    # or one of the group options, in order to keep the original "remucs [OPTIONS] FILES..." usage.
+    OPTIONS = ['-h', '--help', '-V', '--version']
+
+    def parse_args(self, ctx, args):
+
+        if args and args[0] not in self.commands and args[0] not in self.OPTIONS:
+            args = ['remix'] + list(args)
+
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=RemucsGroup,
+                               help='Remix the specified audio files by default, see "remucs remix --help", or run one of the commands below.',
+                               context_settings={'help_option_names': ['-h', '--help']})
+@click.version_option(
+                               VERSION,
+                               '-V', '--version',
+                               message='%(version)s')
+def main():
+
+    pass
+
+
+def options(kwargs: Dict[str, Any]) -> RemucsOptions:
+
+    # converts the remaining remix command line options into the corresponding remucs options
+    return RemucsOptions(
+        quiet=kwargs['quiet'],
+        fine=kwargs['fine'],
+        norm=kwargs['norm'],
+        mono=kwargs['mono'],
+        bala=list(map(float, kwargs['bala'].split(','))),
+        gain=list(map(float, kwargs['gain'].split(','))),
+        a4=kwargs['a4'],
+        confidence=kwargs['confidence'],
+        duration=kwargs['duration'],
+        decimation=kwargs['decimation'],
+        pitch=semitone(kwargs['pitch']) * cent(kwargs['pitch']),
+        dtype='float32' if kwargs['float32'] else 'float64',
+        cache=bytesize(kwargs['cachesize']) if kwargs['cachesize'] else None,
+        reuse=kwargs['reuse'],
+        raw=kwargs['raw'],
+        memory=kwargs['memory'] or not kwargs['store'],
+        store=kwargs['store'],
+        merge=kwargs['merge'],
+        complement=kwargs['complement'],
+        window=kwargs['window'])
+
+
+@main.command('remix',
+                               short_help='Remix the specified audio files (default).',
                                context_settings={'help_option_names': ['-h', '--help']},
                                no_args_is_help=True)
 @click.argument('files',
@@ -44,15 +103,77 @@ VERSION = importlib.metadata.version('remucs')
                                default=None,
                                type=int,
                                help='Target tuning reference frequency, to automatically estimate the pitch shifting factor (experimental).')
+@click.option('--confidence',
+                               default=None,
+                               type=click.FloatRange(min=0, max=1),
+                               help='Stop the tuning estimation as soon as the estimated reference frequency reaches this confidence, e.g. 0.5.')
+@click.option('--duration',
+                               default=None,
+                               type=click.FloatRange(min=0, min_open=True),
+                               help='Maximum duration in seconds to be analyzed by the tuning estimation.')
+@click.option('--decimation',
+                               default=1,
+                               show_default=True,
+                               type=click.IntRange(min=1),
+                               help='Estimate the tuning only at every n-th sample, e.g. 16, which speeds up the tuning estimation.')
 @click.option('-p', '--pitch',
                                default='0',
                                show_default=True,
                                help='Pitch shifting factor in semitones followed by cents, e.g -12 or +12 or +3-50.')
+@click.option('--float32',
+                               default=False,
+                               is_flag=True,
+                               help='Process audio in single instead of double precision.')
 @click.option('-d', '--data',
                                default=pathlib.Path().home(),
                                show_default=True,
                                type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path),
                                help='Directory where to store the intermediate files.')
+@click.option('-c', '--cache', 'cachesize',
+                               default=None,
+                               help='Maximum size of the stem cache, e.g. 10G, otherwise unlimited.')
+@click.option('-r', '--reuse',
+                               default=False,
+                               is_flag=True,
+                               help='Keep pitch shifted stems and remixed outputs in the stem cache for subsequent runs.')
+@click.option('--raw',
+                               default=False,
+                               is_flag=True,
+                               help='Cache the stems as memory mapped raw float32 arrays instead of audio files.')
+@click.option('--memory',
+                               default=False,
+                               is_flag=True,
+                               help='Pass the separated stems directly to the remix, while caching them in the background.')
+@click.option('--store/--no-store',
+                               default=True,
+                               show_default=True,
+                               help='Whether to keep newly separated stems in the stem cache, otherwise implies --memory.')
+@click.option('--merge',
+                               default=False,
+                               is_flag=True,
+                               help='Shift the bass and other stems at once, if mixed with equal weights, to save time.')
+@click.option('--complement',
+                               default=False,
+                               is_flag=True,
+                               help='Derive the mix of all but one stem from the original input minus the excluded stem, if possible.')
+@click.option('--window',
+                               default=None,
+                               type=click.FloatRange(min=1, min_open=False),
+                               help='Separate long inputs in overlapping windows of the specified seconds to limit the memory usage.')
+@click.option('-j', '--jobs',
+                               default=1,
+                               show_default=True,
+                               type=click.IntRange(min=1),
+                               help='Number of files to be remixed in parallel, while separating the next one.')
+@click.option('--profile',
+                               default=None,
+                               type=click.Path(dir_okay=False, writable=True, path_type=pathlib.Path),
+                               help='Write the timing and memory usage of each processing stage as JSON lines to the specified file, ' +
+                                    'implies --local and --jobs 1.')
+@click.option('-l', '--local',
+                               default=False,
+                               is_flag=True,
+                               help='Process the files locally, even if the remucs daemon is running.')
 @click.option('-q', '--quiet',
                                default=False,
                                is_flag=True,
@@ -61,26 +182,77 @@ VERSION = importlib.metadata.version('remucs')
                                VERSION,
                                '-V', '--version',
                                message='%(version)s')
-def main(files, fine, norm, mono, bala, gain, a4, pitch, data, quiet):
+def remix(files, data, jobs, profile, local, **kwargs):
+
+    try:
+
+        opts = options(kwargs)
+
+        # submit the files to the remucs daemon if running, otherwise process them locally
+        errors = submit(files, data, opts, jobs) if not local and not profile else None
+
+        if errors is None and profile:
+
+            # the stages of the parallel jobs would run in separate processes
+            with open(profile, 'w', encoding='utf-8') as stream, profiling.profile(profiling.jsonlines(stream)):
+                errors = batch(files, data, opts)
+
+        elif errors is None:
+
+            errors = batch(files, data, opts, jobs)
+
+    except Exception as error:
+
+        click.echo(traceback.format_exc(), err=True)
+
+        raise click.ClickException(str(error))
+
+    if errors:
+
+        for file, error in errors.items():
+
+            click.echo(''.join(traceback.format_exception(error)), err=True)
+            click.echo(f'Unable to process {file.resolve()}: {error}', err=True)
+
+        raise click.ClickException(
+            f'Failed to process {len(errors)} of {len(set(files))} files!')
+
+
+@main.command('serve',
+                               help='Run the remucs daemon, which processes the files submitted by the remix command.',
+                               context_settings={'help_option_names': ['-h', '--help']})
+@click.option('-f', '--fine',
+                               default=False,
+                               is_flag=True,
+                               help=f'Preload fine-tuned "{MODELS[1]}" model.')
+@click.option('-d', '--data',
+                               default=pathlib.Path().home(),
+                               show_default=True,
+                               type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path),
+                               help='Directory where to store the intermediate files and the daemon socket.')
+@click.option('-w', '--workers',
+                               default=1,
+                               show_default=True,
+                               type=click.IntRange(min=1),
+                               help='Number of jobs to be processed concurrently.')
+@click.option('-s', '--size',
+                               default=16,
+                               show_default=True,
+                               type=click.IntRange(min=1),
+                               help='Maximum number of pending jobs, before the submitting clients have to wait.')
+@click.option('-q', '--quiet',
+                               default=False,
+                               is_flag=True,
+                               help='Don\'t trash stdout.')
+def daemon(fine, data, workers, size, quiet):
 
     try:
 
-        bala  = list(map(float, bala.split(',')))
-        gain  = list(map(float, gain.split(',')))
-        pitch = semitone(pitch) * cent(pitch)
+        serve(data, RemucsOptions(quiet=quiet, fine=fine), workers, size)
 
-        opts = RemucsOptions(
-            quiet=quiet,
-            fine=fine,
-            norm=norm,
-            mono=mono,
-            bala=bala,
-            gain=gain,
-            a4=a4,
-            pitch=pitch)
+    except KeyboardInterrupt:
 
-        for file in list(set(files)):
-            remucs(file, data, opts)
+        pass
 
     except Exception as error:
 
@@ -89,6 +261,57 @@ def main(files, fine, norm, mono, bala, gain, a4, pitch, data, quiet):
         raise click.ClickException(str(error))
 
 
+@main.group('cache',
+                               help='Manage the cached stems.',
+                               context_settings={'help_option_names': ['-h', '--help']})
+def stemcache():
+
+    pass
+
+
+data_option = click.option('-d', '--data',
+                               default=pathlib.Path().home(),
+                               show_default=True,
+                               type=click.Path(exists=True, file_okay=False, dir_okay=True, path_type=pathlib.Path),
+                               help='Directory where the intermediate files are stored.')
+
+
+@stemcache.command('list', help='List cached stems, most recently used first.')
+@data_option
+def stemcache_list(data):
+
+    for entry in cache.entries(data / REMUCS):
+
+        access = datetime.datetime.fromtimestamp(entry.access).isoformat(' ', 'seconds')
+
+        click.echo(f'{entry.digest[:16]} {entry.model} {entry.version} {entry.size / (1 << 20):.1f}M {access} {",".join(entry.files)}')
+
+
+@stemcache.command('stats', help='Show stem cache statistics.')
+@data_option
+def stemcache_stats(data):
+
+    entries = cache.entries(data / REMUCS)
+    size    = sum(entry.size for entry in entries)
+
+    click.echo(f'Location {(data / REMUCS / cache.STEMS).resolve()}')
+    click.echo(f'Entries  {len(entries)}')
+    click.echo(f'Tracks   {len(set(entry.digest for entry in entries))}')
+    click.echo(f'Size     {size / (1 << 20):.1f}M')
+
+
+@stemcache.command('prune', help='Drop least recently used stems.')
+@data_option
+@click.option('-s', '--size',
+                               default='0',
+                               show_default=True,
+                               help='Maximum size of the stem cache after pruning, e.g. 10G.')
+def stemcache_prune(data, size):
+
+    for entry in cache.evict(data / REMUCS, bytesize(size)):
+        click.echo(f'Dropping {entry.path.resolve()}')
+
+
 if __name__ == '__main__':
 
     main()  # pylint: disable=no-value-for-parameter
@@ -1,33 +1,98 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict
+from typing import Any, Dict, List, Mapping, Tuple, Union
+from numpy.typing import NDArray
 
-import os
+import functools
+import importlib.metadata
+import importlib.util
+import threading
 import warnings
 
 import click
 import numpy
+import soundfile
 import tqdm
 
+from remucs import cache, profiling
 from remucs.options import RemucsOptions
-from remucs.utils import filehash
 
-DEMUCS = None
 
-try:
-    import demucs.separate  # >= 4.0
-    DEMUCS = 'demucs.separate'
-except ModuleNotFoundError:
-    pass
+@functools.cache
+def backend() -> Union[str, None]:
 
-try:
-    import demucs.api  # >= 4.1
-    DEMUCS = 'demucs.api'
-except ModuleNotFoundError:
-    pass
+    # The demucs modules pull in torch, which takes seconds to import,
+    # so they are only looked up here and imported as soon as the first separation is about to run.
+
+    try:
+
+        if importlib.util.find_spec('demucs.api') and importlib.util.find_spec('torch'):  # >= 4.1
+            return 'demucs.api'
+
+        if importlib.util.find_spec('demucs.separate'):  # >= 4.0
+            return 'demucs.separate'
+
+    except ModuleNotFoundError:
+        pass
 
-if not DEMUCS:
     warnings.warn('In order to use remucs, you also need to install demucs!')
 
+    return None
+
+
+def demucs_version() -> str:
+
+    try:
+        return importlib.metadata.version('demucs')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+@dataclass
+class Stems:
+
+    path:       Path
+    samplerate: int
+    samples:    Dict[str, NDArray]
+    store:      Union[Future, None] = None
+
+
+SEPARATORS: Dict[Tuple[str, Union[str, None]], Any] = {}
+SEPARATORS_LOCK = threading.RLock()
+
+
+def separator(model: str, device: Union[str, None] = None) -> Any:
+
+    key = (model, device)
+
+    with SEPARATORS_LOCK:
+
+        if key not in SEPARATORS:
+
+            import demucs.api  # pylint: disable=import-outside-toplevel
+
+            # keep the default device of demucs unless specified otherwise
+            SEPARATORS[key] = demucs.api.Separator(model=model) if device is None else \
+                              demucs.api.Separator(model=model, device=device)
+
+        return SEPARATORS[key]
+
+
+def close(model: Union[str, None] = None, device: Union[str, None] = None):
+
+    with SEPARATORS_LOCK:
+
+        for key in list(SEPARATORS.keys()):
+
+            if model is not None and key[0] != model:
+                continue
+
+            if device is not None and key[1] != device:
+                continue
+
+            del SEPARATORS[key]
+
 
 def analyze_demucs_separate(src: Path, dst: Dict[str, Path], opts: RemucsOptions):
 
@@ -42,10 +107,16 @@ def analyze_demucs_separate(src: Path, dst: Dict[str, Path], opts: RemucsOptions
     if not opts.quiet:
         click.echo(f'Executing demucs with args \"{" ".join(args)}\"')
 
+    # the command line interface only separates the entire input at once
+    if opts.window:
+        warnings.warn('The separation in windows requires the demucs.api, so ignoring the specified window size!')
+
+    import demucs.separate  # pylint: disable=import-outside-toplevel
+
     demucs.separate.main(args)
 
 
-def analyze_demucs_api(src: Path, dst: Dict[str, Path], opts: RemucsOptions):
+def separate_demucs_api(src: Path, opts: RemucsOptions) -> Tuple[Dict[str, NDArray], int]:
 
     def callback(args):
 
@@ -69,78 +140,383 @@ def analyze_demucs_api(src: Path, dst: Dict[str, Path], opts: RemucsOptions):
     progress  = tqdm.tqdm(total=100) \
                 if not opts.quiet else None
 
-    separator = demucs.api.Separator(
-        model=opts.model,
-        callback=callback,
-        callback_arg={'progress': progress})
-
-    # WORKAROUND
-    # The `separate_audio_file` function throws the following error when dealing with .wav files:
-    #   RuntimeError: unsupported operation:
-    #   More than one element of the written-to tensor refers to a single memory location.
-    #   Please clone() the tensor before performing the operation.
-    # Therefore, load the input file manually and clone the resulting tensor as suggested.
-    original  = separator._load_audio(src).clone()
-    separated = separator.separate_tensor(original, separator.samplerate)[-1]
+    # The separator instance is shared between files,
+    # so keep it locked while the callback belongs to the current one.
+    with SEPARATORS_LOCK:
+
+        instance = separator(opts.model, opts.device)
+
+        instance.update_parameter(
+            callback=callback,
+            callback_arg={'progress': progress})
+
+        try:
+
+            # WORKAROUND
+            # The `separate_audio_file` function throws the following error when dealing with .wav files:
+            #   RuntimeError: unsupported operation:
+            #   More than one element of the written-to tensor refers to a single memory location.
+            #   Please clone() the tensor before performing the operation.
+            # Therefore, load the input file manually and clone the resulting tensor as suggested.
+            original   = instance._load_audio(src).clone()
+            separated  = instance.separate_tensor(original, instance.samplerate)[-1]
+            samplerate = instance.samplerate
+            assert sorted(separated.keys()) == sorted(opts.stems)
+
+            if progress is not None:
+                progress.update(numpy.clip(100 - progress.n, 0, 100))
+
+        finally:
+
+            instance.update_parameter(
+                callback=None,
+                callback_arg=None)
+
+            if progress is not None:
+                progress.close()
+
+    stems = {}
+
+    for stem, samples in separated.items():
+
+        # transposed view of the (channels, frames) tensor without copying,
+        # rescaled like `demucs.api.save_audio` does to prevent clipping
+        samples = samples.detach().cpu().numpy().T
+        peak    = numpy.max(numpy.abs(samples), initial=0)
+
+        stems[stem] = samples / (1.01 * peak) if 1.01 * peak > 1 else samples
+
+    return stems, samplerate
+
+
+def save_audio(dst: Path, samples: NDArray, samplerate: int):
+
+    import demucs.api  # pylint: disable=import-outside-toplevel
+    import torch       # pylint: disable=import-outside-toplevel
+
+    # the format and clipping prevention of the `demucs.api.save_audio` defaults
+    demucs.api.save_audio(torch.from_numpy(numpy.ascontiguousarray(samples.T)), dst, samplerate=samplerate)
+
+
+def save_demucs_api(stems: Dict[str, NDArray], samplerate: int, dst: Dict[str, Path], opts: RemucsOptions):
+
+    def save(stem: str, samples: NDArray):
+
+        with profiling.span('save', file=str(dst[stem].resolve())) as record:
+
+            if dst[stem].suffix == cache.RAW:
+                cache.rawsave(dst[stem], samples)
+            else:
+                save_audio(dst[stem], samples, samplerate)
+
+            if record is not None:
+                record['written'] = dst[stem].stat().st_size
+
+    # the stems are encoded and written concurrently
+    with ThreadPoolExecutor(max_workers=len(stems)) as executor:
+
+        futures = []
+
+        for stem, samples in stems.items():
+
+            if not opts.quiet:
+                click.echo(f'Writing {dst[stem].resolve()}')
+
+            dst[stem].parent.mkdir(parents=True, exist_ok=True)
+
+            futures.append(executor.submit(save, stem, samples))
+
+        for future in futures:
+            future.result()
+
+
+def separate_window(instance: Any, x: NDArray, samplerate: int, opts: RemucsOptions) -> Dict[str, NDArray]:
+
+    import torch  # pylint: disable=import-outside-toplevel
+
+    channels = instance.audio_channels
+
+    # convert the channels like `demucs.audio.convert_audio_channels` does
+    x = numpy.repeat(x, channels, axis=-1) if x.shape[-1] == 1 else x[:, :channels]
+
+    separated = instance.separate_tensor(torch.from_numpy(numpy.ascontiguousarray(x.T)), samplerate)[-1]
     assert sorted(separated.keys()) == sorted(opts.stems)
 
-    if progress is not None:
-        progress.update(numpy.clip(100 - progress.n, 0, 100))
-        progress.close()
+    return {stem: samples.detach().cpu().numpy().T for stem, samples in separated.items()}
+
+
+def crossfade_window(stems: Mapping[str, NDArray], separated: Dict[str, NDArray], offset: int, end: int) -> int:
+
+    length = min(len(next(iter(separated.values()))), max(0, len(next(iter(stems.values()))) - offset))
+
+    # linear crossfade with the tail of the previous window
+    n    = min(length, max(0, end - offset))
+    ramp = numpy.linspace(0, 1, n + 2, dtype=numpy.float32)[1:-1, None]
 
     for stem, samples in separated.items():
 
+        stems[stem][offset:offset+n] = stems[stem][offset:offset+n] * (1 - ramp) + samples[:n] * ramp
+        stems[stem][offset+n:offset+length] = samples[n:length]
+
+    return max(end, offset + length)
+
+
+def finalize_window(samples: numpy.memmap, temp: Path, dst: Path, samplerate: int, blocksize: int):
+
+    # The encoded stems are written exactly like the ones separated at once,
+    # even though the whole stem needs to be loaded for that.
+    if dst.suffix != cache.RAW:
+
+        save_audio(dst, samples, samplerate)
+
+        del samples
+        temp.unlink()
+
+        return
+
+    total = len(samples)
+
+    # rescaled like `demucs.api.save_audio` does to prevent clipping
+    peak  = max((numpy.max(numpy.abs(samples[i:i+blocksize]), initial=0) for i in range(0, total, blocksize)), default=0)
+    scale = 1 / (1.01 * peak) if 1.01 * peak > 1 else 1
+
+    if scale != 1:
+        for i in range(0, total, blocksize):
+            samples[i:i+blocksize] *= scale
+
+    samples.flush()
+
+    del samples
+    temp.replace(dst)
+
+
+def separate_demucs_api_windows(src: Path, dst: Dict[str, Path], opts: RemucsOptions) -> int:
+
+    # The input is separated in overlapping windows, which are crossfaded into memory mapped
+    # float32 stem files, so that only a few windows need to be kept in memory at once.
+    temp = {stem: dst[stem].with_name(f'.{dst[stem].name}.partial{cache.RAW}') for stem in opts.stems}
+
+    workers = max(1, opts.workers)
+
+    with SEPARATORS_LOCK, soundfile.SoundFile(src) as file:
+
+        instance   = separator(opts.model, opts.device)
+        samplerate = instance.samplerate
+
+        origin = file.samplerate
+        total  = int(round(file.frames * samplerate / origin))
+
+        window    = max(2, int(opts.window * origin))  # type: ignore
+        crossfade = min(int(opts.crossfade * origin), window // 2)
+        starts    = range(0, max(file.frames - crossfade, 1), window - crossfade)
+
+        stems = {stem: numpy.lib.format.open_memmap(temp[stem], mode='w+', dtype=numpy.float32, shape=(total, 2))
+                 for stem in opts.stems}
+
+        progress = tqdm.tqdm(total=len(starts)) \
+                   if not opts.quiet else None
+
+        end = 0
+
+        def merge(start: int, future: Future):
+
+            nonlocal end
+
+            end = crossfade_window(stems, future.result(), int(round(start * samplerate / origin)), end)
+
+            if progress is not None:
+                progress.update(1)
+
+        try:
+
+            # The next windows are separated concurrently by the specified number of threads,
+            # while the input is read and the stems are crossfaded in order.
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+
+                pending: List[Tuple[int, Future]] = []
+
+                for start in starts:
+
+                    file.seek(start)
+                    x = file.read(window, dtype='float32', always_2d=True)
+
+                    pending.append((start, executor.submit(separate_window, instance, x, origin, opts)))
+
+                    if len(pending) >= workers:
+                        merge(*pending.pop(0))
+
+                for start, future in pending:
+                    merge(start, future)
+
+        finally:
+
+            if progress is not None:
+                progress.close()
+
+    for stem in opts.stems:
+
         if not opts.quiet:
             click.echo(f'Writing {dst[stem].resolve()}')
 
-        dst[stem].parent.mkdir(parents=True, exist_ok=True)
-        demucs.api.save_audio(samples, dst[stem], samplerate=separator.samplerate)
+        finalize_window(stems.pop(stem), temp[stem], dst[stem], samplerate, opts.blocksize)
+
+    return samplerate
+
+
+def analyze_demucs_api(src: Path, dst: Dict[str, Path], opts: RemucsOptions) -> int:
+
+    if opts.window:
+        return separate_demucs_api_windows(src, dst, opts)
+
+    stems, samplerate = separate_demucs_api(src, opts)
+
+    save_demucs_api(stems, samplerate, dst, opts)
+
+    return samplerate
+
+
+def convert(src: Dict[str, Path], dst: Dict[str, Path], opts: RemucsOptions) -> int:
+
+    samplerate = []
+
+    for stem in src:
+
+        if not opts.quiet:
+            click.echo(f'Writing {dst[stem].resolve()}')
+
+        with soundfile.SoundFile(src[stem]) as file:
+
+            samplerate.append(file.samplerate)
+            samples = file.read(dtype='float32', always_2d=True)
+
+        cache.rawsave(dst[stem], samples)
 
+    assert len(set(samplerate)) == 1
 
-def analyze(file: Path, data: Path, opts: RemucsOptions):
+    return samplerate[0]
 
-    suffix = file.suffix
+
+def locate(file: Path, data: Path, opts: RemucsOptions) -> Tuple[Path, Dict[str, Path], bool]:
+
+    suffix = cache.RAW if opts.raw else file.suffix
     model  = opts.model
 
-    src = file
-    dst = {stem: data / model / (stem + suffix) for stem in opts.stems}
+    digest  = cache.filedigest(data, file, opts.digest)
+    version = demucs_version()
 
-    check = data / (opts.digest + suffix)
-    hash0 = check.read_text().strip() if check.exists() else None
-    hash1 = filehash(src, opts.digest).strip()
+    entry = cache.locate(data, digest, version, model)
+    stems = {stem: entry / (stem + suffix) for stem in opts.stems}
 
-    if hash0 != hash1:
+    complete = cache.complete(entry) and all(stem.exists() for stem in stems.values())
 
-        check.unlink(missing_ok=True)
+    return entry, stems, complete
 
-        for stem in data.glob(os.path.join('**', '*') + suffix):
 
-            if not opts.quiet:
-                click.echo(f'Dropping {stem.resolve()}')
+def finish(file: Path, data: Path, entry: Path, opts: RemucsOptions, samplerate: Union[int, None] = None):
+
+    cache.touch(entry, file, samplerate)
 
-            stem.unlink()
+    for dropped in cache.evict(data, opts.cache, keep=[entry]):
 
-        check.write_text(hash1)
+        if not opts.quiet:
+            click.echo(f'Dropping {dropped.path.resolve()}')
 
-    complete = list(set((data / model / (stem + suffix)).exists() for stem in opts.stems))
-    complete = complete[0] if len(complete) == 1 else False
+
+def analyze(file: Path, data: Path, opts: RemucsOptions) -> Path:
+
+    entry, dst, complete = locate(file, data, opts)
+    src = file
 
     if complete:
-        return
+
+        cache.touch(entry, file)
+
+        return entry.parent
+
+    # the stems in the audio file format, which can be converted to raw stems without separation
+    audio = {stem: entry / (stem + file.suffix) for stem in opts.stems}
+
+    if opts.raw and cache.complete(entry) and all(stem.exists() for stem in audio.values()):
+
+        if not opts.quiet:
+            click.echo(f'Converting {entry.resolve()}')
+
+        finish(file, data, entry, opts, convert(audio, dst, opts))
+
+        return entry.parent
 
     if not opts.quiet:
         click.echo(f'Analyzing {src.resolve()}')
 
-    if DEMUCS == 'demucs.separate':
+    entry.mkdir(parents=True, exist_ok=True)
+
+    with profiling.span('separate', file=str(src.resolve()), model=opts.model) as record:
+
+        if backend() == 'demucs.separate':
+
+            analyze_demucs_separate(src, audio, opts)
+
+            samplerate = soundfile.info(audio['other']).samplerate
+
+            if opts.raw:
+
+                samplerate = convert(audio, dst, opts)
+
+                for stem in audio.values():
+                    stem.unlink()
+
+        elif backend() == 'demucs.api':
+
+            samplerate = analyze_demucs_api(src, dst, opts)
+
+        else:
+
+            raise ModuleNotFoundError(
+                'Unable to perform analysis! ' +
+                'Please install demucs and try again.')
+
+        if record is not None:
+            record['read']    = src.stat().st_size
+            record['written'] = sum(stem.stat().st_size for stem in dst.values() if stem.is_file())
+
+    finish(file, data, entry, opts, samplerate)
+
+    return entry.parent
+
+
+def extract(file: Path, data: Path, opts: RemucsOptions) -> Union[Path, Stems]:
+
+    # Keeps the separated stems in memory for the subsequent synthesis,
+    # unless they are already cached, separated in windows to save memory
+    # or only the demucs command line interface is available.
+    entry, dst, complete = locate(file, data, opts)
+    src = file
+
+    if backend() != 'demucs.api' or opts.window or complete or cache.complete(entry):
+        return analyze(file, data, opts)
+
+    if not opts.quiet:
+        click.echo(f'Analyzing {src.resolve()}')
+
+    with profiling.span('separate', file=str(src.resolve()), model=opts.model) as record:
+
+        samples, samplerate = separate_demucs_api(src, opts)
+
+        if record is not None:
+            record['read'] = src.stat().st_size
 
-        analyze_demucs_separate(src, dst, opts)
+    if not opts.store:
+        return Stems(path=data, samplerate=samplerate, samples=samples)
 
-    elif DEMUCS == 'demucs.api':
+    entry.mkdir(parents=True, exist_ok=True)
 
-        analyze_demucs_api(src, dst, opts)
+    def store():
+        save_demucs_api(samples, samplerate, dst, opts)
+        finish(file, data, entry, opts, samplerate)
 
-    else:
+    # write the stems to the cache in the background, while they are being remixed
+    executor = ThreadPoolExecutor(max_workers=1)
+    future   = executor.submit(store)
+    executor.shutdown(wait=False)
 
-        raise ModuleNotFoundError(
-            'Unable to perform analysis! ' +
-            'Please install demucs and try again.')
+    return Stems(path=entry.parent, samplerate=samplerate, samples=samples, store=future)
@@ -0,0 +1,97 @@
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
+from os import PathLike
+from typing import Dict, Iterable, List, Sequence, Tuple, Union
+
+import contextlib
+import multiprocessing
+import pathlib
+
+from remucs import analysis, cache, profiling
+from remucs.options import RemucsOptions
+from remucs.remucs import prepare, remix, remucs, separate
+
+
+def locate(file: pathlib.Path, data: Union[str, PathLike], opts: RemucsOptions) -> pathlib.Path:
+
+    _, root = prepare(file, data, opts)
+
+    return analysis.locate(file, root, opts)[0]
+
+
+def pinned(file: pathlib.Path, data: Union[str, PathLike], opts: RemucsOptions) -> pathlib.Path:
+
+    # Pins the cache entry already before the separation, so that neither the next separation
+    # nor the concurrent jobs of the daemon evict it before being remixed, which unpins it again.
+    entry = locate(file, data, opts)
+    cache.pin(entry)
+
+    try:
+        return separate(file, data, opts)
+    except BaseException:
+        cache.unpin(entry)
+        raise
+
+
+def batch(files: Iterable[Union[str, PathLike]], data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None,
+          jobs: int = 1, pool: Union[Executor, None] = None) -> Dict[pathlib.Path, BaseException]:
+
+    paths: Sequence[pathlib.Path] = list(dict.fromkeys(pathlib.Path(file) for file in files))
+
+    opts = opts or RemucsOptions()
+
+    errors: Dict[pathlib.Path, BaseException] = {}
+
+    # the in-memory stems are not passed between processes
+    if jobs <= 1 or opts.memory:
+
+        for file in paths:
+
+            try:
+                with profiling.span('remucs', file=str(file.resolve())), cache.pinning(locate(file, data, opts)):
+                    remucs(file, data, deepcopy(opts))
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                errors[file] = error
+
+        return errors
+
+    # The separation runs in a single background worker,
+    # whereas the tuning estimation and synthesis run in a pool of processes,
+    # so that the next file is being separated while the previous ones are remixed.
+    context = multiprocessing.get_context('spawn')
+
+    with contextlib.ExitStack() as stack:
+
+        # either the already running processes of the specified pool or a new one
+        separator   = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        synthesizer = pool or stack.enter_context(ProcessPoolExecutor(max_workers=jobs, mp_context=context))
+
+        separations: List[Tuple[pathlib.Path, Future[pathlib.Path]]] = [
+            (file, separator.submit(pinned, file, data, deepcopy(opts)))
+            for file in paths]
+
+        syntheses: List[Tuple[pathlib.Path, Future[None]]] = []
+
+        for file, future in separations:
+
+            error = future.exception()
+
+            if error is not None:
+                errors[file] = error
+                continue
+
+            stems = future.result()
+
+            synthesis = synthesizer.submit(remix, file, data, deepcopy(opts), stems)
+            synthesis.add_done_callback(lambda _, entry=stems / opts.model: cache.unpin(entry))
+
+            syntheses.append((file, synthesis))
+
+        for file, future in syntheses:
+
+            error = future.exception()
+
+            if error is not None:
+                errors[file] = error
+
+    return {file: errors[file] for file in paths if file in errors}
@@ -0,0 +1,315 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
+from numpy.typing import NDArray
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+
+from remucs.utils import filehash
+
+STEMS = 'stems'
+FILES = 'files'
+ENTRY = 'entry.json'
+RAW   = '.npy'
+
+# entries still in use by pending remixes, which must not be evicted
+PINNED: Dict[Path, int] = {}
+PINNED_LOCK = threading.Lock()
+
+
+@dataclass
+class CacheEntry:
+
+    path:    Path
+    digest:  str
+    version: str
+    model:   str
+    files:   List[str]
+    size:    int
+    access:  float
+
+
+def signature(file: Path, digest: str) -> Dict[str, Any]:
+
+    path = file.resolve()
+    stat = path.stat()
+
+    return {
+        'path':   str(path),
+        'digest': digest,
+        'size':   stat.st_size,
+        'mtime':  stat.st_mtime_ns,
+        'inode':  stat.st_ino,
+        'device': stat.st_dev,
+    }
+
+
+def load(meta: Path) -> Dict[str, Any]:
+
+    try:
+        return json.loads(meta.read_text(encoding='utf-8')) if meta.is_file() else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save(meta: Path, data: Dict[str, Any]):
+
+    # The metadata is replaced at once, so that concurrent readers never see a partially written file.
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=meta.parent, prefix=f'.{meta.name}.', suffix='.partial',
+                                     delete=False) as stream:
+        try:
+            stream.write(json.dumps(data, indent=2))
+        except BaseException:
+            stream.close()
+            os.unlink(stream.name)
+            raise
+
+    os.replace(stream.name, meta)
+
+
+def filedigest(root: Path, file: Path, digest: str) -> str:
+
+    # Reuses the previously computed file digest as long as the file stat remains the same,
+    # so that only modified files need to be hashed again.
+    path = file.resolve()
+    meta = root / FILES / (hashlib.sha1(str(path).encode()).hexdigest() + '.json')
+    data = load(meta)
+    sign = signature(path, digest)
+
+    if data.get('signature') == sign:
+        return data['hash']
+
+    value = filehash(path, digest).strip()
+
+    meta.parent.mkdir(parents=True, exist_ok=True)
+    save(meta, {'signature': sign, 'hash': value})
+
+    return value
+
+
+def sidecar(file: Path, name: str, digest: str) -> Tuple[Path, Dict[str, Any]]:
+
+    # The sidecar file keeps derived values next to the specified file,
+    # which are only valid as long as the file content remains the same.
+    meta = file.with_name(f'{file.name}.{name}.json')
+    data = load(meta)
+    sign = signature(file, digest)
+
+    if data.get('signature') != sign:
+
+        value = filehash(file, digest).strip()
+
+        if data.get('hash') != value:
+            data = {'hash': value, 'values': {}}
+
+        data['signature'] = sign
+
+        # keep the refreshed signature of the unchanged content, in order not to hash the file again next time
+        if data['values']:
+            save(meta, data)
+
+    return meta, data
+
+
+def recall(file: Path, name: str, params: Dict[str, Any], digest: str) -> Union[Dict[str, Any], None]:
+
+    _, data = sidecar(file, name, digest)
+
+    return data['values'].get(json.dumps(params, sort_keys=True))
+
+
+def remember(file: Path, name: str, params: Dict[str, Any], digest: str, value: Dict[str, Any]):
+
+    meta, data = sidecar(file, name, digest)
+
+    data['values'][json.dumps(params, sort_keys=True)] = value
+
+    save(meta, data)
+
+
+def fingerprint(params: Dict[str, Any]) -> str:
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def locate(root: Path, digest: str, version: str, model: str) -> Path:
+
+    return root / STEMS / digest / version / model
+
+
+def complete(entry: Path) -> bool:
+
+    return (entry / ENTRY).is_file()
+
+
+def touch(entry: Path, file: Union[Path, None] = None, samplerate: Union[int, None] = None):
+
+    meta = entry / ENTRY
+
+    if meta.is_file() and file is None and samplerate is None:
+        meta.touch()
+        return
+
+    data  = load(meta)
+    files = data.get('files', [])
+
+    if file is not None and file.name not in files:
+        files.append(file.name)
+
+    data.update(
+        digest=entry.parent.parent.name,
+        version=entry.parent.name,
+        model=entry.name,
+        files=files)
+
+    if samplerate is not None:
+        data.update(samplerate=samplerate)
+
+    save(meta, data)
+
+
+def rawstem(file: Path) -> Tuple[NDArray, int]:
+
+    # The raw stems are memory mapped float32 arrays of shape (frames, channels),
+    # whose sample rate is kept in the metadata of the corresponding entry.
+    return numpy.load(file, mmap_mode='r'), int(load(file.parent / ENTRY)['samplerate'])
+
+
+def rawsave(file: Path, samples: NDArray, blocksize: int = 1 << 16):
+
+    temp = file.with_name(f'.{file.name}.partial{file.suffix}')
+    data = numpy.lib.format.open_memmap(temp, mode='w+', dtype=numpy.float32, shape=samples.shape)
+
+    for i in range(0, len(samples), blocksize):
+        data[i:i+blocksize] = samples[i:i+blocksize]
+
+    data.flush()
+    del data
+
+    temp.replace(file)
+
+
+def entries(root: Path) -> List[CacheEntry]:
+
+    result = []
+
+    for meta in sorted((root / STEMS).glob('/'.join(['*'] * 3 + [ENTRY]))):
+
+        entry = meta.parent
+        data  = load(meta)
+
+        # skip the entries, which are being dropped or are unreadable otherwise
+        if not {'digest', 'version', 'model'} <= data.keys():
+            continue
+
+        try:
+            size   = sum(file.stat().st_size for file in entry.rglob('*') if file.is_file())
+            access = meta.stat().st_mtime
+        except FileNotFoundError:
+            continue
+
+        result.append(CacheEntry(
+            path=entry,
+            digest=data['digest'],
+            version=data['version'],
+            model=data['model'],
+            files=data.get('files', []),
+            size=size,
+            access=access))
+
+    return sorted(result, key=lambda entry: entry.access, reverse=True)
+
+
+def drop(entry: Path):
+
+    shutil.rmtree(entry, ignore_errors=True)
+
+    # also remove the empty version and digest directories
+    for parent in [entry.parent, entry.parent.parent]:
+        try:
+            parent.rmdir()
+        except OSError:
+            break
+
+
+def forget(root: Path, digests: Iterable[str]):
+
+    digests = set(digests)
+
+    if not digests:
+        return
+
+    for meta in (root / FILES).glob('*.json'):
+        if load(meta).get('hash') in digests:
+            meta.unlink(missing_ok=True)
+
+
+def pin(entry: Path):
+
+    path = entry.resolve()
+
+    with PINNED_LOCK:
+        PINNED[path] = PINNED.get(path, 0) + 1
+
+
+def unpin(entry: Path):
+
+    path = entry.resolve()
+
+    with PINNED_LOCK:
+        PINNED[path] -= 1
+        if not PINNED[path]:
+            del PINNED[path]
+
+
+@contextlib.contextmanager
+def pinning(entry: Path) -> Iterator[Path]:
+
+    pin(entry)
+
+    try:
+        yield entry
+    finally:
+        unpin(entry)
+
+
+def evict(root: Path, budget: Union[int, None], keep: Iterable[Path] = ()) -> List[CacheEntry]:
+
+    if budget is None:
+        return []
+
+    with PINNED_LOCK:
+        pinned = list(PINNED)
+
+    keep    = [path.resolve() for path in keep] + pinned
+    dropped = []
+
+    cached = entries(root)
+    size   = sum(entry.size for entry in cached)
+
+    # start with the least recently used entry
+    for entry in reversed(cached):
+
+        if size <= budget:
+            break
+
+        if entry.path.resolve() in keep:
+            continue
+
+        drop(entry.path)
+        dropped.append(entry)
+
+        size -= entry.size
+
+    # also forget the file digests of the tracks, which are no longer cached at all
+    forget(root, {entry.digest for entry in dropped} - {entry.digest for entry in cached if entry not in dropped})
+
+    return dropped
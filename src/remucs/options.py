@@ -3,7 +3,7 @@ from typing import List, Union
 
 
 @dataclass
-class RemucsOptions:
+class RemucsOptions:  # pylint: disable=too-many-instance-attributes
 
     quiet: bool = True
 
@@ -14,15 +14,36 @@ class RemucsOptions:
     bala: List[float] = field(default_factory=lambda: [0]*4)
     gain: List[float] = field(default_factory=lambda: [1]*4)
 
-    a4:        Union[int, None] = None
-    pitch:     float = 1
-    quefrency: float = 1e-3
+    device: Union[str, None] = None
+
+    a4:         Union[int, None] = None
+    confidence: Union[float, None] = None
+    duration:   Union[float, None] = None
+    decimation: int = 1
+    pitch:      float = 1
+    quefrency:  float = 1e-3
 
     order:   int = 13
     overlap: int = 4
 
+    dtype:     str = 'float64'
+    blocksize: int = 1 << 16
+    batchsize: float = 1
+    workers:   int = 1
+
     remucs: str = '.remucs'
     digest: str = 'sha256'
+    cache:  Union[int, None] = None
+    reuse:  bool = False
+    raw:    bool = False
+    memory: bool = False
+    store:  bool = True
+
+    complement: bool = False
+    merge:      bool = False
+
+    window:    Union[float, None] = None
+    crossfade: float = 1
 
     @property
     def stems(self) -> List[str]:
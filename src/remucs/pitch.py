@@ -0,0 +1,460 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple, Union
+from numpy.typing import ArrayLike, NDArray
+
+import contextlib
+
+import numpy
+import soundfile
+
+from stftpitchshift.stft import symmetric_window
+
+from remucs import profiling
+
+
+def wrap(x: NDArray) -> NDArray:
+
+    return (x + numpy.pi) % (2 * numpy.pi) - numpy.pi
+
+
+def dot(x: NDArray, y: NDArray) -> NDArray:
+
+    # batched equivalent of the `numpy.dot` function along the last axis,
+    # which in contrast to `numpy.sum(x * y)` yields bitwise identical results
+    return numpy.matmul(x[..., None, :], y[..., :, None])[..., 0, 0]
+
+
+@dataclass
+class Stft:
+
+    # The STFT windows and phase vocoder constants, which only depend on the parameters
+    # and on the processing precision, but not on the processed signal.
+    analysis_window:  NDArray
+    synthesis_window: NDArray
+    bins:             NDArray
+    freqinc:          float
+    phaseinc:         float
+    resamplers:       List[Tuple[float, NDArray, NDArray, NDArray]]
+
+
+def precompute(samplerate: int, factors: NDArray, framesize: int, hopsize: int, dtype: numpy.dtype = numpy.dtype(float)) -> Stft:
+
+    window = symmetric_window(framesize)
+    bins   = framesize // 2 + 1
+
+    # precompute the linear spectral resampling indices and weights
+    # according to the `stftpitchshift.resampler.linear` function
+    resamplers = []
+
+    for factor in factors:
+
+        m = int(bins * factor)
+        q = bins / m
+
+        i = numpy.arange(min(bins, m))
+        k = i * q
+
+        j = numpy.trunc(k).astype(int)
+        k = k - j
+
+        ok = (0 <= j) & (j < bins - 1)
+
+        resamplers.append((factor, i[ok], j[ok], k[ok].astype(dtype)))
+
+    return Stft(
+        analysis_window=window.astype(dtype),
+        synthesis_window=(window * hopsize / numpy.sum(window * window)).astype(dtype),
+        bins=numpy.arange(bins).astype(dtype),
+        freqinc=samplerate / framesize,
+        phaseinc=2 * numpy.pi * hopsize / framesize,
+        resamplers=resamplers)
+
+
+class PitchShifter:
+
+    # Streaming counterpart of the `stftpitchshift.StftPitchShift.shiftpitch` function,
+    # which processes an arbitrarily long signal chunk by chunk
+    # while carrying the frame overlap and phase vocoder state over the chunk boundaries.
+    # All channels are processed at once as a (frames, channels, bins) batch.
+    # Since all spectral operations are frame local and the overlap-add is performed
+    # in the same order, the output matches the whole-signal result sample for sample.
+
+    def __init__(self, *, samplerate: int,
+                          factor: float,
+                          quefrency: float,
+                          framesize: int,
+                          hopsize: int,
+                          normalize: bool = True,
+                          chunksize: int = 32):
+
+        assert framesize % hopsize == 0
+        assert chunksize > 0
+
+        self.samplerate = samplerate
+        self.factors    = numpy.asarray(factor).flatten()
+        self.quefrency  = int(quefrency * samplerate)
+        self.framesize  = framesize
+        self.hopsize    = hopsize
+        self.normalize  = normalize
+        self.chunksize  = chunksize
+
+        self.stft = precompute(samplerate, self.factors, framesize, hopsize)
+
+        self.encoder = numpy.zeros(0)
+        self.decoder = numpy.zeros(0)
+
+        self.input  = numpy.zeros(0)
+        self.output = numpy.zeros(0)
+
+        self.consumed = 0
+        self.produced = 0
+        self.channels = 0
+        self.shape    = ()
+        self.dtype    = None
+        self.real     = numpy.dtype(float)
+
+    def process(self, x: ArrayLike) -> NDArray:
+
+        x = numpy.asarray(x)
+        assert x.ndim in (1, 2)
+
+        if self.dtype is None:
+            self.setup(x)
+
+        assert x.shape[1:] == self.shape
+
+        self.consumed += len(x)
+        self.input = numpy.concatenate((self.input, numpy.reshape(x, (len(x), -1)).T.astype(self.real, copy=False)), axis=-1)
+
+        framesize = self.framesize
+        hopsize   = self.hopsize
+
+        frames = max(0, (self.input.shape[-1] - framesize) // hopsize + 1)
+        chunks: List[NDArray] = []
+
+        for offset in range(0, frames, self.chunksize):
+
+            count = min(self.chunksize, frames - offset)
+            begin = offset * hopsize
+            end   = begin + (count - 1) * hopsize + framesize
+
+            chunks.append(self.transform(self.input[:, begin:end], count))
+
+        self.input = self.input[:, frames * hopsize:]
+
+        y = numpy.concatenate(chunks, axis=-1) if chunks else numpy.zeros((self.channels, 0), self.real)
+        self.produced += y.shape[-1]
+
+        return self.restore(y)
+
+    def flush(self) -> NDArray:
+
+        if self.dtype is None:
+            return numpy.zeros(0)
+
+        # The samples after the last complete frame are not covered by any further frame,
+        # thus the pending overlap-add tail completes the output up to the input length.
+        size = self.consumed - self.produced
+        y    = numpy.zeros((self.channels, size), self.real)
+        n    = min(size, self.output.shape[-1])
+
+        y[:, :n] = self.output[:, :n]
+
+        self.input    = numpy.zeros((self.channels, 0), self.real)
+        self.output   = numpy.zeros((self.channels, self.framesize), self.real)
+        self.produced = self.consumed
+
+        return self.restore(y)
+
+    def setup(self, x: NDArray):
+
+        self.dtype    = x.dtype
+        self.shape    = x.shape[1:]
+        self.channels = int(numpy.prod(self.shape))
+
+        # single precision input is also processed in single precision,
+        # everything else in double precision as usual
+        self.real = numpy.dtype(numpy.float32 if x.dtype == numpy.float32 else float)
+
+        self.stft = precompute(self.samplerate, self.factors, self.framesize, self.hopsize, self.real)
+
+        bins = len(self.stft.bins)
+
+        self.encoder = numpy.zeros((self.channels, bins), self.real)
+        self.decoder = numpy.zeros((self.channels, bins), self.real)
+
+        self.input  = numpy.zeros((self.channels, 0), self.real)
+        self.output = numpy.zeros((self.channels, self.framesize), self.real)
+
+    def restore(self, y: NDArray) -> NDArray:
+
+        y = numpy.reshape(y.T, (y.shape[-1],) + self.shape)
+
+        return y.astype(self.dtype, copy=False)
+
+    def transform(self, x: NDArray, count: int) -> NDArray:
+
+        framesize = self.framesize
+        hopsize   = self.hopsize
+
+        frames = numpy.lib.stride_tricks.sliding_window_view(x, framesize, axis=-1)[:, ::hopsize]
+        frames = numpy.swapaxes(frames, 0, 1)
+        frames = numpy.fft.rfft(frames * self.stft.analysis_window, axis=-1, norm='forward')
+        assert len(frames) == count
+
+        frames = self.encode(frames)
+
+        if self.normalize:
+            frames0 = frames.copy()
+
+        if self.quefrency:
+
+            envelopes = self.lifter(frames)
+
+            mask = numpy.isinf(envelopes) | \
+                   numpy.isnan(envelopes) | \
+                   (numpy.abs(envelopes) < numpy.finfo(envelopes.dtype).tiny)
+
+            # the magnitudes are kept in the real parts and scaled in place
+            magns = numpy.real(frames)
+            magns /= envelopes
+            magns[mask] = 0
+
+            frames = self.shiftpitch(frames)
+
+            magns = numpy.real(frames)
+            magns *= envelopes
+            magns[mask] = 0
+
+        else:
+
+            frames = self.shiftpitch(frames)
+
+        if self.normalize:
+            frames = self.normalization(frames, frames0)
+
+        frames = self.decode(frames)
+
+        frames[...,  0] = 0
+        frames[..., -1] = 0
+
+        frames = numpy.fft.irfft(frames, axis=-1, norm='forward') * self.stft.synthesis_window
+
+        y = numpy.concatenate((self.output, numpy.zeros((self.channels, count * hopsize), self.real)), axis=-1)
+
+        for i, frame in enumerate(frames):
+            y[:, i * hopsize:i * hopsize + framesize] += frame
+
+        self.output = y[:, count * hopsize:]
+
+        return y[:, :count * hopsize]
+
+    def encode(self, frames: NDArray) -> NDArray:
+
+        magn = numpy.abs(frames)
+        arg  = numpy.angle(frames)
+
+        delta = arg - numpy.concatenate((self.encoder[None], arg[:-1]))
+        self.encoder = arg[-1].copy()
+
+        i = self.stft.bins
+        j = wrap(delta - i * self.stft.phaseinc) / self.stft.phaseinc
+
+        freq = (i + j) * self.stft.freqinc
+
+        return magn + 1j * freq
+
+    def decode(self, frames: NDArray) -> NDArray:
+
+        magn = numpy.real(frames)
+        freq = numpy.imag(frames)
+
+        i = self.stft.bins
+        j = (freq - i * self.stft.freqinc) / self.stft.freqinc
+
+        delta = (i + j) * self.stft.phaseinc
+
+        # The accumulated phase grows with every frame and would run out of single precision,
+        # so keep it wrapped in that case, which is equivalent modulo the full circle.
+        if self.real == numpy.float32:
+            delta = wrap(delta)
+
+        arg = numpy.cumsum(numpy.concatenate((self.decoder[None], delta)), axis=0)[1:]
+        self.decoder = arg[-1].copy() if self.real != numpy.float32 else wrap(arg[-1])
+
+        return magn * numpy.exp(1j * arg)
+
+    def lifter(self, frames: NDArray) -> NDArray:
+
+        quefrency = self.quefrency
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            spectrum = numpy.log10(numpy.real(frames))
+
+        cepstrum = numpy.fft.irfft(spectrum, axis=-1, norm='forward')
+
+        cepstrum[..., 1:quefrency] *= 2
+        cepstrum[..., quefrency+1:] = 0
+
+        cepstrum = numpy.fft.rfft(cepstrum, axis=-1, norm='forward')
+
+        return numpy.power(10, numpy.real(cepstrum))
+
+    def shiftpitch(self, frames: NDArray) -> NDArray:
+
+        magns = numpy.zeros((len(self.factors),) + frames.shape, self.real)
+        freqs = numpy.zeros((len(self.factors),) + frames.shape, self.real)
+
+        for index, (factor, i, j, k) in enumerate(self.stft.resamplers):
+
+            if factor == 1:
+                magns[index] = numpy.real(frames)
+                freqs[index] = numpy.imag(frames) * factor
+                continue
+
+            magns[index][..., i] = k * numpy.real(frames[..., j + 1]) + (1 - k) * numpy.real(frames[..., j])
+            freqs[index][..., i] = k * numpy.imag(frames[..., j + 1]) + (1 - k) * numpy.imag(frames[..., j])
+            freqs[index] *= factor
+
+        magns[(freqs <= 0) | (freqs >= self.samplerate / 2)] = 0
+
+        if len(self.factors) == 1:
+            return magns[0] + 1j * freqs[0]
+
+        mask = numpy.argmax(magns, axis=0)[None]
+
+        magns = numpy.take_along_axis(magns, mask, axis=0)[0]
+        freqs = numpy.take_along_axis(freqs, mask, axis=0)[0]
+
+        return magns + 1j * freqs
+
+    def normalization(self, frames: NDArray, frames0: NDArray) -> NDArray:
+
+        a = dot(numpy.real(frames0), numpy.real(frames0))
+        b = dot(numpy.real(frames), numpy.real(frames))
+
+        c = numpy.sqrt(a / numpy.where(b == 0, 1, b))[..., None]
+
+        return numpy.where((b == 0)[..., None], frames, numpy.real(frames) * c + 1j * numpy.imag(frames))
+
+
+def reblock(chunks: Iterable[NDArray], blocksize: int) -> Iterator[NDArray]:
+
+    buffer: List[NDArray] = []
+    size = 0
+
+    for chunk in chunks:
+
+        buffer.append(chunk)
+        size += len(chunk)
+
+        if size < blocksize:
+            continue
+
+        data = numpy.concatenate(buffer)
+        size = len(data) % blocksize
+
+        for i in range(0, len(data) - size, blocksize):
+            yield data[i:i+blocksize]
+
+        buffer = [data[len(data)-size:]]
+
+    if size > 0:
+        yield numpy.concatenate(buffer)
+
+
+def shiftpitch_blocks(blocks: Iterable[NDArray], *, blocksize: int,
+                                                     samplerate: int,
+                                                     factor: float,
+                                                     quefrency: float,
+                                                     framesize: int,
+                                                     hopsize: int,
+                                                     normalize: bool = True) -> Iterator[NDArray]:
+
+    shifter = PitchShifter(
+        samplerate=samplerate,
+        factor=factor,
+        quefrency=quefrency,
+        framesize=framesize,
+        hopsize=hopsize,
+        normalize=normalize)
+
+    def chunks() -> Iterator[NDArray]:
+
+        for block in blocks:
+
+            block = numpy.atleast_2d(block)
+            assert len(block.shape) == 2 and block.shape[-1] == 2
+
+            yield shifter.process(block)
+
+        yield numpy.reshape(shifter.flush(), (-1, 2))
+
+    # the span also covers the time the consumer spends between the shifted blocks
+    with profiling.span('shiftpitch', factor=factor, quefrency=quefrency) as record:
+
+        frames = 0
+
+        for block in reblock(chunks(), blocksize):
+            frames += len(block)
+            yield block
+
+        if record is not None:
+            record['frames'] = frames
+
+
+def shiftpitch_file(src: Union[Path, NDArray], dst: Path, channel: Union[int, None] = None, *, blocksize: int,
+                                                                             samplerate: int,
+                                                                             factor: float,
+                                                                             quefrency: float,
+                                                                             framesize: int,
+                                                                             hopsize: int,
+                                                                             normalize: bool = True):
+
+    # Shifts either a single or all channels of the source file into the corresponding columns
+    # of the destination .npy file, which is shared between the worker processes.
+    y = numpy.load(dst, mmap_mode='r+')
+    i = 0
+
+    columns = slice(None) if channel is None else channel
+
+    shifter = PitchShifter(
+        samplerate=samplerate,
+        factor=factor,
+        quefrency=quefrency,
+        framesize=framesize,
+        hopsize=hopsize,
+        normalize=normalize)
+
+    with profiling.span('shiftpitch', factor=factor, quefrency=quefrency, channel=channel) as record:
+
+        with contextlib.ExitStack() as stack:
+
+            # the source is either a stem file or the already decoded stem samples
+            if isinstance(src, Path) and src.suffix == '.npy':
+                src = numpy.load(src, mmap_mode='r')
+
+            if isinstance(src, numpy.ndarray):
+                blocks = (src[j:j+blocksize].astype(y.dtype, copy=False) for j in range(0, len(src), blocksize))
+            else:
+                file = stack.enter_context(soundfile.SoundFile(src))
+                assert file.samplerate == samplerate
+                blocks = file.blocks(blocksize, always_2d=True, dtype=y.dtype.name)
+
+            for block in blocks:
+
+                chunk = shifter.process(block[:, columns])
+                y[i:i+len(chunk), columns] = chunk
+                i += len(chunk)
+
+        chunk = shifter.flush()
+        y[i:i+len(chunk), columns] = chunk
+        i += len(chunk)
+
+        assert i == len(y)
+
+        y.flush()
+
+        if record is not None:
+            record['frames'] = i
@@ -0,0 +1,125 @@
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, IO, Iterator, List, Union
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ModuleNotFoundError:
+    resource = None  # type: ignore # pylint: disable=invalid-name
+
+Hook = Callable[[Dict[str, Any]], None]
+
+HOOKS: List[Hook] = []
+HOOKS_LOCK = threading.Lock()
+
+
+def hook(callback: Hook) -> Hook:
+
+    with HOOKS_LOCK:
+        HOOKS.append(callback)
+
+    return callback
+
+
+def unhook(callback: Hook):
+
+    with HOOKS_LOCK:
+        HOOKS.remove(callback)
+
+
+@contextlib.contextmanager
+def profile(callback: Hook) -> Iterator[Hook]:
+
+    hook(callback)
+
+    try:
+        yield callback
+    finally:
+        unhook(callback)
+
+
+def jsonlines(stream: IO[str]) -> Hook:
+
+    # The records may be emitted by multiple threads at once,
+    # so write each of them as a single line under the lock.
+    lock = threading.Lock()
+
+    def callback(record: Dict[str, Any]):
+        line = json.dumps(record, default=str) + '\n'
+        with lock:
+            stream.write(line)
+            stream.flush()
+
+    return callback
+
+
+def maxrss() -> int:
+
+    # This is the peak memory usage of the entire process so far, not of the individual stage.
+    # The ru_maxrss value is inherited from the parent process on Linux,
+    # so prefer the high water mark of the current process image if available.
+    status = Path('/proc/self/status')
+
+    if status.is_file():
+        for line in status.read_text(encoding='utf-8').splitlines():
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+    if resource is None:
+        return 0
+
+    # in bytes on macOS, otherwise in kilobytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def span(stage: str, **fields: Any) -> ContextManager[Union[Dict[str, Any], None]]:
+
+    # Without any hooks, the span neither measures nor emits anything,
+    # so the caller only needs to fill in additional fields of a non-empty record.
+    if not HOOKS:
+        return contextlib.nullcontext()
+
+    return measure(stage, fields)
+
+
+@contextlib.contextmanager
+def measure(stage: str, fields: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+
+    record = {
+        'stage':  stage,
+        'thread': threading.current_thread().name,
+        'time':   time.time(),
+        **fields,
+    }
+
+    wall = time.perf_counter()
+    cpu  = time.thread_time()
+    proc = time.process_time()
+
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = type(error).__name__
+        raise
+    finally:
+
+        # The cpu time only covers the current thread, whereas the process time
+        # also includes all other threads running at the same time.
+        record.update(
+            wall=time.perf_counter() - wall,
+            cpu=time.thread_time() - cpu,
+            process=time.process_time() - proc,
+            maxrss=maxrss())
+
+        with HOOKS_LOCK:
+            hooks = list(HOOKS)
+
+        for callback in hooks:
+            callback(record)
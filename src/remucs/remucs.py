@@ -1,17 +1,21 @@
+from concurrent.futures import wait
+from dataclasses import replace
 from os import PathLike
-from typing import Union
+from typing import Tuple, Union
 
 import pathlib
 
 import click
 
+from remucs import cache, profiling
 from remucs.options import RemucsOptions
-from remucs.analysis import analyze
+from remucs.analysis import Stems, analyze, extract
 from remucs.synthesis import synthesize
 from remucs.tuning import howto_shift_pitch
 
 
-def remucs(file: Union[str, PathLike], data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None):
+def prepare(file: Union[str, PathLike], data: Union[str, PathLike] = '~',
+            opts: Union[RemucsOptions, None] = None) -> Tuple[pathlib.Path, pathlib.Path]:
 
     file = pathlib.Path(file)
 
@@ -27,20 +31,111 @@ def remucs(file: Union[str, PathLike], data: Union[str, PathLike] = '~', opts: U
 
     opts = opts or RemucsOptions()
 
+    data = data / opts.remucs
+    data.mkdir(parents=True, exist_ok=True)
+
+    return file, data
+
+
+def separate(file: Union[str, PathLike], data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None) -> pathlib.Path:
+
+    opts = opts or RemucsOptions()
+
+    file, data = prepare(file, data, opts)
+
     if not opts.quiet:
         click.echo(f'Processing {file.resolve()}')
 
-    data = data / opts.remucs / file.stem
-    data.mkdir(parents=True, exist_ok=True)
+    with profiling.span('analyze', file=str(file.resolve())):
+        return analyze(file, data, opts)
+
+
+def remix(file: Union[str, PathLike], data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None,
+          stems: Union[pathlib.Path, Stems, None] = None):
+
+    opts = opts or RemucsOptions()
+
+    file, data = prepare(file, data, opts)
+
+    # locate the cached stems unless already known from the previous separation
+    if not stems:
+        with profiling.span('analyze', file=str(file.resolve())):
+            stems = analyze(file, data, opts)
+
+    samples = None
+
+    if isinstance(stems, Stems):
+
+        # nothing to reuse unless the in-memory stems are being cached as well
+        if stems.store is None:
+            opts = replace(opts, reuse=False)
+
+        samples = stems.samples, stems.samplerate
+        data    = stems.path
+
+    else:
+
+        data = stems
 
     src = file
     dst = file.with_suffix(opts.remucs + file.suffix)
 
-    analyze(src, data, opts)
-
     if opts.a4:
 
-        file       = data / opts.model / ('other' + src.suffix)
-        opts.pitch = howto_shift_pitch(file, opts)
+        file = data / opts.model / ('other' + (cache.RAW if opts.raw else src.suffix))
+        other = (samples[0]['other'], samples[1]) if samples else None
+
+        with profiling.span('tuning', file=str(file.resolve()), a4=opts.a4) as record:
+
+            opts = replace(opts, pitch=howto_shift_pitch(file, opts, other))
+
+            if record is not None:
+                record['pitch'] = opts.pitch
+
+    with profiling.span('synthesize', file=str(dst.resolve())) as record:
+
+        synthesize(dst, data, opts, samples, src)
+
+        if record is not None:
+            record['written'] = dst.stat().st_size
+
+
+def remucs(file: Union[str, PathLike], data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None):
+
+    opts = opts or RemucsOptions()
+
+    if not opts.memory:
+
+        stems = separate(file, data, opts)
+
+        remix(file, data, opts, stems)
+
+        return
+
+    # The separated stems are directly passed to the synthesis,
+    # while optionally being written to the cache in the background.
+    file, root = prepare(file, data, opts)
+
+    if not opts.quiet:
+        click.echo(f'Processing {file.resolve()}')
+
+    with profiling.span('analyze', file=str(file.resolve())):
+        extracted = extract(file, root, opts)
+
+    store = extracted.store if isinstance(extracted, Stems) else None
+
+    try:
+
+        # pass the original data path to the remix, which prepares it once again
+        remix(file, data, opts, extracted)
+
+    except BaseException:
+
+        # wait for the background store without replacing the original error by its own
+        if store is not None:
+            wait([store])
+
+        raise
 
-    synthesize(dst, data, opts)
+    if store is not None:
+        store.result()
@@ -0,0 +1,251 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass, field
+from os import PathLike
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Union
+
+import json
+import multiprocessing
+import queue
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+import click
+
+from remucs import analysis
+from remucs.batch import batch
+from remucs.options import RemucsOptions
+
+SOCKET = 'remucs.sock'
+
+
+@dataclass
+class Job:
+
+    files:  List[Path]
+    data:   Path
+    opts:   RemucsOptions
+    jobs:   int = 1
+    errors: Dict[str, str] = field(default_factory=dict)
+    done:   threading.Event = field(default_factory=threading.Event)
+
+
+def address(data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None) -> Path:
+
+    opts = opts or RemucsOptions()
+
+    return Path(data).expanduser() / opts.remucs / SOCKET
+
+
+def connect(path: Path) -> Union[socket.socket, None]:
+
+    if not hasattr(socket, 'AF_UNIX') or not path.is_socket():
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(str(path))
+    except OSError:
+        client.close()
+        return None
+
+    return client
+
+
+def send(stream: Any, message: Dict[str, Any]):
+
+    stream.write((json.dumps(message) + '\n').encode())
+    stream.flush()
+
+
+def receive(stream: Any) -> Dict[str, Any]:
+
+    line = stream.readline()
+
+    if not line:
+        raise ConnectionError('The remucs daemon closed the connection unexpectedly!')
+
+    return json.loads(line)
+
+
+def warm(pools: Dict[int, Executor], lock: threading.Lock, jobs: int) -> Union[Executor, None]:
+
+    # The remixing processes are kept alive for the subsequent jobs with the same number of parallel jobs,
+    # so that only the first one needs to spawn them and to import the dependencies.
+    if jobs <= 1:
+        return None
+
+    with lock:
+
+        if jobs not in pools:
+            pools[jobs] = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+
+        return pools[jobs]
+
+
+def work(jobs: queue.Queue, pools: Dict[int, Executor], lock: threading.Lock):
+
+    while True:
+
+        job  = jobs.get()
+        pool = warm(pools, lock, job.jobs)
+
+        try:
+
+            errors = batch(job.files, job.data, job.opts, job.jobs, pool)
+            job.errors.update({str(file): ''.join(traceback.format_exception(error)) for file, error in errors.items()})
+
+            # spawn new processes next time, if one of them terminated abruptly
+            if any(isinstance(error, BrokenProcessPool) for error in errors.values()):
+                with lock:
+                    if pools.get(job.jobs) is pool:
+                        del pools[job.jobs]
+
+        except Exception:  # pylint: disable=broad-exception-caught
+            job.errors.update({str(file): traceback.format_exc() for file in job.files})
+        finally:
+            job.done.set()
+            jobs.task_done()
+
+
+def serve(data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None,
+          workers: int = 1, size: int = 16, stop: Union[threading.Event, None] = None):
+
+    opts = opts or RemucsOptions()
+    data = Path(data).expanduser()
+    path = address(data, opts)
+
+    client = connect(path)
+
+    if client is not None:
+        client.close()
+        raise RuntimeError(f'The remucs daemon is already running at "{path}"!')
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+
+    # The jobs are accepted as long as the queue is not full, otherwise the client is asked to retry later,
+    # and a fixed number of worker threads process them while sharing the loaded separator.
+    jobs: queue.Queue = queue.Queue(size)
+
+    pools: Dict[int, Executor] = {}
+    lock = threading.Lock()
+
+    for _ in range(workers):
+        threading.Thread(target=work, args=(jobs, pools, lock), daemon=True).start()
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+
+            line = self.rfile.readline()
+
+            # nothing to do if the client disconnected without any request, e.g. after probing the daemon
+            if not line:
+                return
+
+            request = json.loads(line)
+
+            job = Job(
+                files=[Path(file) for file in request['files']],
+                data=Path(request['data']),
+                opts=RemucsOptions(**request['opts']),
+                jobs=int(request.get('jobs', 1)))
+
+            try:
+                jobs.put_nowait(job)
+            except queue.Full:
+                send(self.wfile, {'status': 'busy'})
+                return
+
+            send(self.wfile, {'status': 'queued', 'position': jobs.qsize()})
+
+            job.done.wait()
+
+            send(self.wfile, {'status': 'done', 'errors': job.errors})
+
+    preload(opts)
+
+    with socketserver.ThreadingUnixStreamServer(str(path), Handler) as server:  # type: ignore
+
+        server.daemon_threads = True
+
+        if not opts.quiet:
+            click.echo(f'Listening on {path.resolve()}')
+
+        # optionally shut down as soon as the specified event is set, otherwise run until interrupted
+        def watch():
+            stop.wait()  # type: ignore
+            server.shutdown()
+
+        if stop is not None:
+            threading.Thread(target=watch, daemon=True).start()
+
+        try:
+            server.serve_forever()
+        finally:
+            path.unlink(missing_ok=True)
+
+            with lock:
+                for pool in pools.values():
+                    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def preload(opts: RemucsOptions):
+
+    if analysis.backend() == 'demucs.api':
+
+        if not opts.quiet:
+            click.echo(f'Loading {opts.model}')
+
+        analysis.separator(opts.model, opts.device)
+
+
+def submit(files: Iterable[Union[str, PathLike]], data: Union[str, PathLike] = '~', opts: Union[RemucsOptions, None] = None,
+           jobs: int = 1, retry: float = 1) -> Union[Dict[Path, BaseException], None]:
+
+    # Returns the errors of the submitted files like `remucs.batch.batch` does,
+    # or nothing if the daemon is not running.
+    opts  = opts or RemucsOptions()
+    files = [Path(file).resolve() for file in files]
+    path  = address(data, opts)
+
+    request = {
+        'files': [str(file) for file in files],
+        'data':  str(Path(data).expanduser().resolve()),
+        'opts':  asdict(opts),
+        'jobs':  jobs,
+    }
+
+    while True:
+
+        client = connect(path)
+
+        if client is None:
+            return None
+
+        with client, client.makefile('rwb') as stream:
+
+            send(stream, request)
+            response = receive(stream)
+
+            if response['status'] == 'busy':
+
+                if not opts.quiet:
+                    click.echo(f'Waiting for the remucs daemon at {path.resolve()}')
+
+                time.sleep(retry)
+                continue
+
+            if not opts.quiet:
+                click.echo(f'Submitted {len(files)} files to the remucs daemon at {path.resolve()}')
+
+            response = receive(stream)
+            assert response['status'] == 'done'
+
+            return {Path(file): RuntimeError(error) for file, error in response['errors'].items()}
@@ -1,13 +1,25 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Union
+from typing import Dict, Iterator, List, Literal, Sequence, Tuple, Union
 from numpy.typing import ArrayLike, NDArray
 
+import contextlib
+import multiprocessing
+import shutil
+import tempfile
+
 import click
 import numpy
 import soundfile
-import stftpitchshift
 
+from remucs import cache, profiling
 from remucs.options import RemucsOptions
+from remucs.pitch import PitchShifter, shiftpitch_blocks, shiftpitch_file
+from remucs.utils import prefetch, writeback
+
+RENDERS = 'renders'
+SHIFTED = 'shifted'
 
 
 def stereo_balance_weights(balance: Union[ArrayLike, None], size: int) -> NDArray:
@@ -46,88 +58,446 @@ def shiftpitch(x: ArrayLike, *, samplerate: int,
                                 normalize: bool = True) -> NDArray:
 
     x = numpy.atleast_2d(x)
-    y = numpy.zeros_like(x)
     assert len(x.shape) == 2 and x.shape[-1] == 2
 
-    pitchshifter = stftpitchshift.StftPitchShift(
+    pitchshifter = PitchShifter(
         framesize=framesize,
         hopsize=hopsize,
-        samplerate=samplerate)
+        samplerate=samplerate,
+        factor=factor,
+        quefrency=quefrency,
+        normalize=normalize)
+
+    return numpy.concatenate((pitchshifter.process(x), numpy.reshape(pitchshifter.flush(), (-1, 2))))
+
 
-    for i in range(x.shape[-1]):
+def mixdown(x: NDArray, bala: NDArray, gain: NDArray, mono: bool) -> NDArray:
 
-        y[:, i] = pitchshifter.shiftpitch(x[:, i],
-            factors=factor,           # type: ignore
-            quefrency=quefrency,      # type: ignore
-            normalization=normalize)
+    if mono:
+        x = numpy.mean(x, axis=-1)
+        x = numpy.repeat(x[..., None], 2, axis=-1)
 
-    return y
+    return numpy.sum(x * bala.astype(x.dtype, copy=False) * gain.astype(x.dtype, copy=False), axis=0)
 
 
-def synthesize(file: Path, data: Path, opts: RemucsOptions):
+def partial(file: Path) -> Path:
 
-    suffix = file.suffix
-    model  = opts.model
+    return file.with_name(f'.{file.name}.partial{file.suffix}')
 
-    src = [data / model / (stem + suffix) for stem in sorted(opts.stems)]
-    dst = file
 
-    norm = opts.norm
-    mono = opts.mono
+def blocks(x: NDArray, blocksize: int) -> Iterator[NDArray]:
+
+    for i in range(0, len(x), blocksize):
+        yield x[i:i+blocksize]
+
+
+def plan(bala: NDArray, gain: NDArray, pitch: float, complement: bool) -> Tuple[List[int], Union[int, None]]:
+
+    # The stems with zero gain don't contribute to the mix,
+    # so they neither need to be read nor pitch shifted.
+    keep = [i for i in range(len(gain)) if numpy.any(gain[i] != 0)] or [0]
+    skip = [i for i in range(len(gain)) if i not in keep]
+
+    # If all but one stem are mixed with equal weights and without pitch shifting,
+    # their sum can be approximated by the original mix minus the excluded stem.
+    weights = bala * gain
+
+    if complement and pitch == 1 and len(skip) == 1 and all(numpy.array_equal(weights[i], weights[keep[0]]) for i in keep):
+        return skip, skip[0]
+
+    return keep, None
+
+
+@dataclass
+class Synthesis:
+
+    bala:        NDArray
+    gain:        NDArray
+    pitch:       float
+    keep:        List[int]
+    exclude:     Union[int, None]
+    merge:       List[int]
+    source:      str
+    shifts:      List[int]
+    quefrencies: List[float]
+    shifted:     List[Path]
+
+
+def compatible(mix: Path, stem: Path, samples: Union[Tuple[Dict[str, NDArray], int], None]) -> bool:
+
+    # The original mix can only replace the separated stems,
+    # if both have the same sample rate and length.
+    if samples is not None:
+        frames, samplerate = len(samples[0][stem.stem]), samples[1]
+    elif stem.suffix == cache.RAW:
+        x, samplerate = cache.rawstem(stem)
+        frames = len(x)
+    else:
+        info = soundfile.info(stem)
+        frames, samplerate = info.frames, info.samplerate
+
+    info = soundfile.info(mix)
+
+    return info.samplerate == samplerate and info.frames == frames and info.channels <= 2
+
+
+def source(src: List[Path], samples: Union[Tuple[Dict[str, NDArray], int], None]) -> str:
+
+    # The separated stems are either kept as float32 samples in memory or in raw stem files,
+    # or encoded in an audio file format with a possibly lower resolution, e.g. PCM_16.
+    if samples is not None or src[0].suffix == cache.RAW:
+        return 'float32'
+
+    info = soundfile.info(src[0])
+
+    return f'{info.format}/{info.subtype}'
+
+
+def mergeable(bala: NDArray, gain: NDArray, pitch: float, keep: List[int], opts: RemucsOptions) -> List[int]:
+
+    # The bass and other stems are optionally summed up and shifted at once, if mixed with equal weights,
+    # which saves one of three pitch shifting passes at the cost of a slightly different result.
+    bass  = opts.stems.index('bass')
+    other = opts.stems.index('other')
+
+    if not opts.merge or pitch == 1 or bass not in keep or other not in keep:
+        return []
+
+    if not numpy.array_equal(bala[bass] * gain[bass], bala[other] * gain[other]):
+        return []
+
+    return [bass, other]
+
+
+def schedule(data: Path, src: List[Path], opts: RemucsOptions, samples: Union[Tuple[Dict[str, NDArray], int], None] = None,
+             mix: Union[Path, None] = None) -> Synthesis:
 
     bala = stereo_balance_weights(opts.bala, len(opts.stems))
     gain = stereo_gain_weights(opts.gain, len(opts.stems))
 
-    pitch = opts.pitch
+    pitch = opts.pitch if opts.pitch and opts.pitch > 0 and opts.pitch != 1 else 1
+
+    # the stems to be mixed and optionally the one to be subtracted from the original mix instead
+    keep, exclude = plan(bala, gain, pitch, opts.complement and mix is not None)
+
+    if exclude is not None and (mix is None or not compatible(mix, src[exclude], samples)):
+        keep, exclude = plan(bala, gain, pitch, False)
+
+    # the stems to be summed up before pitch shifting
+    merge = mergeable(bala, gain, pitch, keep, opts)
+
+    if merge:
+        keep.remove(merge[1])
+
+    shifts      = [opts.stems.index(stem) for stem in ['bass', 'other', 'vocals'] if opts.stems.index(stem) in keep]
+    quefrencies = [opts.quefrency if opts.stems[stem] == 'vocals' else 0 for stem in shifts]
+
+    # the pitch shifted stems depend on the format of their source stems as well
+    origin = source(src, samples)
+
+    shifted = [data / opts.model / SHIFTED / (('bass+other' if merge and stem == merge[0] else opts.stems[stem]) + '.' + cache.fingerprint({
+        'source':    origin,
+        'factor':    pitch,
+        'quefrency': quefrencies[i],
+        'framesize': opts.framesize,
+        'hopsize':   opts.hopsize,
+        'dtype':     numpy.dtype(opts.dtype).name,
+    }) + '.npy') for i, stem in enumerate(shifts)]
+
+    return Synthesis(
+        bala=bala,
+        gain=gain,
+        pitch=pitch,
+        keep=keep,
+        exclude=exclude,
+        merge=merge,
+        source=origin,
+        shifts=shifts,
+        quefrencies=quefrencies,
+        shifted=shifted)
+
+
+def lookup(file: Path, data: Path, opts: RemucsOptions, synthesis: Synthesis) -> Path:
+
+    # The rendered output and the pitch shifted stems are optionally kept next to the stems,
+    # keyed by the corresponding synthesis parameters.
+    return data / opts.model / RENDERS / (cache.fingerprint({
+        'suffix':    file.suffix,
+        'source':    synthesis.source,
+        'norm':      opts.norm,
+        'mono':      opts.mono,
+        'bala':      synthesis.bala.tolist(),
+        'gain':      synthesis.gain.tolist(),
+        'pitch':     synthesis.pitch,
+        'quefrency': opts.quefrency,
+        'framesize': opts.framesize,
+        'hopsize':   opts.hopsize,
+        'dtype':     numpy.dtype(opts.dtype).name,
+        'exclude':   synthesis.exclude,
+        'merge':     bool(synthesis.merge),
+    }) + file.suffix)
+
+
+def decoding(opts: RemucsOptions) -> Literal['float32', 'float64']:
+
+    return 'float32' if numpy.dtype(opts.dtype) == numpy.float32 else 'float64'
+
+
+def read(src: List[Path], indices: List[int], opts: RemucsOptions, samples: Union[Tuple[Dict[str, NDArray], int], None],
+         stack: contextlib.ExitStack) -> Tuple[Dict[int, Iterator[NDArray]], int, int]:
+
+    dtype     = numpy.dtype(opts.dtype)
+    blocksize = opts.blocksize
+
+    x: Dict[int, Iterator[NDArray]]
+
+    if samples is None and not opts.raw:
+
+        stems = {i: stack.enter_context(soundfile.SoundFile(src[i])) for i in indices}
+
+        sr     = list(set(stem.samplerate for stem in stems.values()))
+        frames = list(set(stem.frames for stem in stems.values()))
+        assert len(sr) == 1 and len(frames) == 1
+        assert all(stem.channels == 2 for stem in stems.values())
+
+        x = {i: stem.blocks(blocksize, always_2d=True, dtype=decoding(opts)) for i, stem in stems.items()}
+
+        return x, sr[0], frames[0]
+
+    # The stems are taken either directly from the separation or from the memory mapped raw stem files,
+    # and only converted block by block if necessary.
+    if samples is None:
+        raw    = {i: cache.rawstem(src[i]) for i in indices}
+        arrays = {i: stem[0] for i, stem in raw.items()}
+        sr     = list(set(stem[1] for stem in raw.values()))
+    else:
+        arrays = {i: samples[0][opts.stems[i]] for i in indices}
+        sr     = [samples[1]]
+
+    frames = list(set(len(stem) for stem in arrays.values()))
+    assert len(sr) == 1 and len(frames) == 1
+    assert all(stem.shape[-1] == 2 for stem in arrays.values())
+
+    x = {i: (block.astype(dtype, copy=False) for block in blocks(stem, blocksize)) for i, stem in arrays.items()}
+
+    return x, sr[0], frames[0]
+
+
+def shift(x: Dict[int, Iterator[NDArray]], src: List[Path], synthesis: Synthesis, opts: RemucsOptions,
+          samples: Union[Tuple[Dict[str, NDArray], int], None], sr: int, frames: int, temp: Path):
+
+    if not opts.reuse and not (opts.workers > 1 and samples is None):
+
+        for i, stem in enumerate(synthesis.shifts):
+            x[stem] = shiftpitch_blocks(x[stem], blocksize=opts.blocksize,
+                                                 samplerate=sr,
+                                                 factor=synthesis.pitch,
+                                                 quefrency=synthesis.quefrencies[i],
+                                                 framesize=opts.framesize,
+                                                 hopsize=opts.hopsize)
+
+        return
+
+    dtype   = numpy.dtype(opts.dtype)
+    shifted = synthesis.shifted if opts.reuse else [temp / path.name for path in synthesis.shifted]
+    sources = [src[stem] if samples is None else samples[0][opts.stems[stem]] for stem in synthesis.shifts]
+    missing = [i for i in range(len(shifted)) if not shifted[i].is_file()]
+
+    # the summed up stems are to be shifted from a temporary file as well
+    if synthesis.merge and any(synthesis.shifts[i] == synthesis.merge[0] for i in missing):
+
+        merged = numpy.lib.format.open_memmap(temp / 'bass+other.npy', mode='w+', dtype=dtype, shape=(frames, 2))
+        i      = 0
+
+        for block in x[synthesis.merge[0]]:
+            merged[i:i+len(block)] = block
+            i += len(block)
+
+        merged.flush()
+        del merged
+
+        sources[synthesis.shifts.index(synthesis.merge[0])] = temp / 'bass+other.npy'
+
+    for i in missing:
+        shifted[i].parent.mkdir(parents=True, exist_ok=True)
+        numpy.lib.format.open_memmap(partial(shifted[i]), mode='w+', dtype=dtype, shape=(frames, 2))
+
+    if missing and opts.workers > 1 and samples is None:
+
+        # Each stem or stem channel is shifted by a separate worker process
+        # into a shared file, which is then mixed block by block.
+        context = multiprocessing.get_context('spawn')
+
+        # split the stems into individual channels only if there are enough workers,
+        # otherwise shift both channels at once to share the batched processing
+        channels = [0, 1] if opts.workers > len(missing) else [None]
+
+        with ProcessPoolExecutor(max_workers=opts.workers, mp_context=context) as executor:
+
+            futures = [executor.submit(shiftpitch_file, sources[i], partial(shifted[i]), channel,
+                                       blocksize=opts.blocksize,
+                                       samplerate=sr,
+                                       factor=synthesis.pitch,
+                                       quefrency=synthesis.quefrencies[i],
+                                       framesize=opts.framesize,
+                                       hopsize=opts.hopsize)
+                       for i in missing for channel in channels]
+
+            for future in futures:
+                future.result()
+
+    else:
+
+        for i in missing:
+            shiftpitch_file(sources[i], partial(shifted[i]), blocksize=opts.blocksize,
+                                                             samplerate=sr,
+                                                             factor=synthesis.pitch,
+                                                             quefrency=synthesis.quefrencies[i],
+                                                             framesize=opts.framesize,
+                                                             hopsize=opts.hopsize)
+
+    for i in missing:
+        partial(shifted[i]).replace(shifted[i])
+
+    for i, stem in enumerate(synthesis.shifts):
+        x[stem] = blocks(numpy.load(shifted[i], mmap_mode='r'), opts.blocksize)
+
+
+def render(x: Sequence[Iterator[NDArray]], dst: Path, bala: NDArray, gain: NDArray, opts: RemucsOptions,
+           sr: int, frames: int, temp: Path):
+
+    mono  = opts.mono
+    dtype = numpy.dtype(opts.dtype)
+
+    with contextlib.ExitStack() as stack:
+
+        # The stems are read and shifted by separate threads in parallel,
+        # while the output is written in background as soon as the next block is being mixed.
+        # The memory mapped blocks are also materialized by the reading threads.
+        inputs = [prefetch(numpy.array(block) for block in stem) for stem in x]
+
+        for stem in inputs:
+            stack.callback(stem.close)
+
+        path = str(dst.resolve())
+
+        def encode(block: NDArray):
+            with profiling.span('write', file=path, frames=len(block)):
+                output.write(block)
+
+        with soundfile.SoundFile(dst, 'w', samplerate=sr, channels=2) as output, writeback(encode) as write:
+
+            if not opts.norm:
+
+                for block in zip(*inputs):
+                    write(numpy.clip(mixdown(numpy.array(block), bala, gain, mono), -1, +1))
+
+                return
+
+            # The normalization requires the overall peak value in advance,
+            # so keep the unclipped mix in a temporary file in between.
+            y    = numpy.lib.format.open_memmap(temp / 'mix.npy', mode='w+', dtype=dtype, shape=(frames, 2))
+            peak = 0.0
+            i    = 0
+
+            for block in zip(*inputs):
+
+                block = mixdown(numpy.array(block), bala, gain, mono)
+                peak  = max(peak, numpy.max(numpy.abs(block), initial=0))
+
+                y[i:i+len(block)] = block
+                i += len(block)
+
+            assert i == frames
+
+            for block in blocks(y, opts.blocksize):
+                write(numpy.clip(block / (peak or 1), -1, +1))
+
+            del y
+
+
+def report(synthesis: Synthesis, opts: RemucsOptions, mix: Union[Path, None]):
+
+    if synthesis.exclude is not None and mix is not None:
+        click.echo(f'Subtracting {opts.stems[synthesis.exclude]} from {mix.resolve()}')
+    if opts.mono:
+        click.echo('Converting input to mono')
+    if not numpy.all(numpy.equal(numpy.unique(synthesis.bala), 1)):
+        click.echo(f'Applying balance weights {synthesis.bala.tolist()}')
+    if not numpy.all(numpy.equal(numpy.unique(synthesis.gain), 1)):
+        click.echo(f'Applying gain weights {synthesis.gain.tolist()}')
+    if opts.norm:
+        click.echo('Normalizing output')
+
+
+def synthesize(file: Path, data: Path, opts: RemucsOptions, samples: Union[Tuple[Dict[str, NDArray], int], None] = None,
+               mix: Union[Path, None] = None):
+
+    src = [data / opts.model / (stem + (cache.RAW if opts.raw else file.suffix)) for stem in opts.stems]
+    dst = file
+
+    synthesis = schedule(data, src, opts, samples, mix)
+    rendered  = lookup(file, data, opts, synthesis)
+
+    if opts.reuse and rendered.is_file():
+
+        if not opts.quiet:
+            click.echo(f'Reusing {rendered.resolve()}')
+            click.echo(f'Writing {dst.resolve()}')
+
+        shutil.copyfile(rendered, dst)
+        return
 
     if not opts.quiet:
         click.echo(f'Synthesizing {dst.resolve()}')
 
-    x, sr = zip(*[soundfile.read(stem) for stem in src])
+    with contextlib.ExitStack() as stack:
+
+        # only the stems contributing to the mix are being read
+        x, sr, frames = read(src, sorted(synthesis.keep + synthesis.merge[1:]), opts, samples, stack)
+
+        temp = Path(stack.enter_context(tempfile.TemporaryDirectory(dir=data)))
+
+        if synthesis.merge:
+            bass, other = synthesis.merge
+            x[bass] = (a + b for a, b in zip(x[bass], x.pop(other)))
+
+        if synthesis.pitch != 1:
 
-    assert len(list(set(sr))) == 1
-    sr = sr[0]
-    x  = numpy.array(x)
-    assert len(x.shape) == 3 and x.shape[-1] == 2
+            if not opts.quiet:
+                click.echo(f'Applying pitch shifting by factor {synthesis.pitch}')
+                if synthesis.merge:
+                    click.echo('Merging bass and other stems before pitch shifting')
 
-    if pitch and pitch > 0 and pitch != 1:
+            shift(x, src, synthesis, opts, samples, sr, frames, temp)
+
+        exclude = synthesis.exclude
 
         if not opts.quiet:
-            click.echo(f'Applying pitch shifting by factor {pitch}')
-
-        stems       = [opts.stems.index(stem) for stem in ['bass', 'other', 'vocals']]
-        factors     = [pitch] * len(stems)
-        quefrencies = [0, 0, opts.quefrency]
-        framesizes  = [opts.framesize] * len(stems)
-        hopsizes    = [opts.hopsize] * len(stems)
-
-        for i, stem in enumerate(stems):
-            x[stem] = shiftpitch(x[stem],
-                samplerate=sr,
-                factor=factors[i],
-                quefrency=quefrencies[i],
-                framesize=framesizes[i],
-                hopsize=hopsizes[i])
+            report(synthesis, opts, mix)
 
-    if not opts.quiet:
-        if mono:
-            click.echo('Converting input to mono')
-        if not numpy.all(numpy.equal(numpy.unique(bala), 1)):
-            click.echo(f'Applying balance weights {bala.tolist()}')
-        if not numpy.all(numpy.equal(numpy.unique(gain), 1)):
-            click.echo(f'Applying gain weights {gain.tolist()}')
-        if norm:
-            click.echo('Normalizing output')
+        if exclude is not None:
 
-    if mono:
-        x = numpy.mean(x, axis=-1)
-        x = numpy.repeat(x[..., None], 2, axis=-1)
+            # only scheduled if there is an original mix to subtract the excluded stem from
+            assert mix is not None
+
+            i = next(i for i in range(len(opts.stems)) if i != exclude)
+            y = stack.enter_context(soundfile.SoundFile(mix)).blocks(opts.blocksize, always_2d=True, dtype=decoding(opts))
+
+            stems = [((numpy.repeat(a, 2, axis=-1) if a.shape[-1] == 1 else a) - b for a, b in zip(y, x[exclude]))]
+            bala  = synthesis.bala[i:i+1]
+            gain  = synthesis.gain[i:i+1]
+
+        else:
 
-    y = numpy.sum(x * bala * gain, axis=0)
+            stems = [x[i] for i in synthesis.keep]
+            bala  = synthesis.bala[synthesis.keep]
+            gain  = synthesis.gain[synthesis.keep]
 
-    if norm:
-        y /= numpy.max(numpy.abs(y)) or 1
+        render(stems, dst, bala, gain, opts, sr, frames, temp)
 
-    y = numpy.clip(y, -1, +1)
+    if opts.reuse:
 
-    soundfile.write(dst, y, sr)
+        rendered.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(dst, partial(rendered))
+        partial(rendered).replace(rendered)
@@ -1,26 +1,24 @@
 from pathlib import Path
-from typing import Tuple, Union
+from typing import Any, Callable, Dict, Generator, Iterable, Iterator, Tuple, Union
 from numpy.typing import ArrayLike, NDArray
 
+import contextlib
+import fractions
+import functools
+import itertools
+
 import click
 import numpy
-import resampy
 import soundfile
 import tqdm
 
-from qdft import QDFT
-from qdft.fafe import QFAFE
-
+from remucs import cache
 from remucs.options import RemucsOptions
+from remucs.pitch import reblock
+from remucs.utils import prefetch
 
 
-def findpeaks(x: ArrayLike, n: int) -> NDArray:
-
-    x = numpy.atleast_2d(x)
-
-    assert len(x.shape) == 2
-    assert x.shape[0] > 0
-    assert x.shape[1] > 3
+def findpeaks_numpy(x: NDArray, n: int, indices: NDArray, values: NDArray):
 
     a = x[..., 0:-3]
     y = x[..., 1:-2]
@@ -29,46 +27,269 @@ def findpeaks(x: ArrayLike, n: int) -> NDArray:
     i = (y > a) & (y > b)
     j = numpy.argpartition(numpy.negative(y * i), n)[..., :n]
 
-    return j + 1
+    numpy.add(j, 1, out=indices)
+    values[:] = numpy.take_along_axis(x, indices, axis=-1)
 
 
-def resample(file: Path, samplerate: Union[int, None]) -> Tuple[NDArray, int]:
+def findpeaks_numba(x: NDArray, n: int, indices: NDArray, values: NDArray):  # pylint: disable=too-many-branches
 
-    samples, origin = soundfile.read(file)
-    samples = numpy.atleast_1d(samples)
+    # Keeps the n largest local maxima of each row in descending order by insertion,
+    # and fills up missing peaks with the remaining bins in ascending order.
+    for row in range(x.shape[0]):
 
-    assert len(samples.shape) <= 2
-    assert samples.shape[0] > 0
+        xs = x[row]
+        js = indices[row]
+        ys = values[row]
 
-    if samples.ndim > 1:
-        samples = numpy.mean(samples, axis=-1)
+        count = 0
+        floor = -numpy.inf
 
-    if samplerate is None:
-        samplerate = origin
+        left  = xs[0]
+        value = xs[1]
 
-    if samplerate != origin:
-        samples = resampy.resample(samples, origin, samplerate)
+        for col in range(1, x.shape[1] - 2):
 
-    assert samplerate is not None
-    return samples, samplerate
+            right = xs[col + 1]
 
+            if value > left and value > right and value > floor:
 
-def analyze(src: Path, opts: RemucsOptions) -> Tuple[NDArray, NDArray]:
+                k = min(count, n - 1)
 
-    if not opts.quiet:
-        click.echo(f'Analyzing {src.resolve()}')
+                while k > 0 and ys[k - 1] < value:
+                    js[k] = js[k - 1]
+                    ys[k] = ys[k - 1]
+                    k -= 1
+
+                js[k] = col
+                ys[k] = value
+
+                count = min(count + 1, n)
+
+                if count == n:
+                    floor = ys[n - 1]
+
+            left  = value
+            value = right
+
+        if count < n:
+
+            for col in range(1, x.shape[1] - 2):
+
+                if count == n:
+                    break
+
+                value = xs[col]
+
+                if value > xs[col - 1] and value > xs[col + 1]:
+                    continue
+
+                js[count] = col
+                ys[count] = value
+
+                count += 1
+
+
+@functools.cache
+def findpeaks_kernel() -> Callable[[NDArray, int, NDArray, NDArray], None]:
+
+    # numba takes a while to import, so the kernel is only compiled as soon as the first peaks are about to be found
+    try:
+        import numba  # pylint: disable=import-outside-toplevel
+    except ModuleNotFoundError:
+        return findpeaks_numpy
+
+    return numba.njit(cache=True, nogil=True)(findpeaks_numba)
+
+
+def findpeaks(x: ArrayLike, n: int, indices: Union[NDArray, None] = None,
+                                    values: Union[NDArray, None] = None) -> Tuple[NDArray, NDArray]:
+
+    x = numpy.atleast_2d(x)
+
+    assert len(x.shape) == 2
+    assert x.shape[0] > 0
+    assert x.shape[1] > 3 + n
+
+    # the output buffers can be preallocated for subsequent calls
+    indices = numpy.empty((x.shape[0], n), int) if indices is None else indices[:x.shape[0]]
+    values  = numpy.empty((x.shape[0], n), x.dtype) if values is None else values[:x.shape[0]]
+
+    findpeaks_kernel()(numpy.ascontiguousarray(x), n, indices, values)
+
+    return indices, values
+
+
+def qdft_numba(dfts: NDArray, inputs: NDArray, outputs: NDArray, periods: NDArray, offsets: NDArray, weights: NDArray,
+               fiddles: NDArray, twiddles: NDArray, window: Tuple[float, float], rows: NDArray):
+
+    # Slides the QDFT sample by sample like `qdft.QDFT.qdft` does, but only keeps the current state
+    # and applies the window at the specified rows only, instead of all rows of the batch.
+    a, b = window[0], window[1] / 2
+
+    k = 0
+
+    for i in range(len(inputs) - periods[0]):
+
+        for j in range(outputs.shape[0]):
+
+            left  = inputs[offsets[j] + periods[j] + i]
+            right = inputs[offsets[j] + i]
+
+            delta1 = (fiddles[-1] * left - right) * weights[j]
+            delta2 = (fiddles[0] * left - right) * weights[j]
+            delta3 = (fiddles[+1] * left - right) * weights[j]
+
+            outputs[j, -1] = twiddles[-1, j] * (outputs[j, -1] + delta1)
+            outputs[j,  0] = twiddles[0, j] * (outputs[j,  0] + delta2)
+            outputs[j, +1] = twiddles[+1, j] * (outputs[j, +1] + delta3)
+
+        if k < len(rows) and rows[k] == i:
+
+            for j in range(outputs.shape[0]):
+                dfts[k, j] = a * outputs[j, 0] + b * (outputs[j, -1] + outputs[j, +1])
+
+            k += 1
+
+
+@functools.cache
+def qdft_kernel() -> Callable[..., None]:
+
+    # numba is already required by the qdft package itself
+    import numba  # pylint: disable=import-outside-toplevel
+
+    return numba.njit(cache=True, nogil=True, fastmath=True)(qdft_numba)
+
+
+def qdft_decimated(qdft: Any, samples: NDArray, start: int, decimation: int) -> NDArray:
+
+    # Same as `qdft.qdft(samples)[start::decimation]`, but without allocating and windowing the discarded rows,
+    # since the sliding DFT itself still needs to be updated at every sample.
+    if decimation == 1 or qdft.window is None:
+        return qdft.qdft(samples)[start::decimation]
+
+    samples = numpy.asarray(samples, float)
+    inputs  = numpy.concatenate((qdft.inputs, samples))
+
+    numpy.copyto(qdft.inputs, inputs[len(samples):])
+
+    rows = numpy.arange(start, len(samples), decimation)
+    dfts = numpy.empty((len(rows), qdft.size), complex)
+
+    qdft_kernel()(dfts, inputs, qdft.outputs, qdft.periods, qdft.offsets, qdft.weights,
+                  qdft.fiddles, qdft.twiddles, qdft.window, rows)
+
+    return dfts
+
+
+def resample_blocks(blocks: Iterable[NDArray], origin: int, samplerate: int) -> Iterator[NDArray]:
+
+    if samplerate == origin:
+        yield from blocks
+        return
+
+    # pylint: disable=import-outside-toplevel
+    import resampy
+    from resampy.filters import get_filter
+
+    # The resampling ratio p/q maps every q input samples to exactly p output samples,
+    # so that input segments starting at multiples of q can be resampled separately.
+    ratio = fractions.Fraction(samplerate, origin)
+    p, q  = ratio.numerator, ratio.denominator
+
+    # Each segment is extended by the input context covered by the resampling filter on both sides,
+    # which is the number of filter zero crossings scaled by the downsampling ratio.
+    window, precision, _ = get_filter('kaiser_best')
+    zeros   = len(window) // precision
+    width   = (zeros if p >= q else -(-zeros * q // p)) + 1
+    context = int(numpy.ceil(width / q)) * q
+
+    def segment(x: NDArray) -> NDArray:
+        y = resampy.resample(x, origin, samplerate)
+        return y[context * p // q:(len(x) - context) * p // q]
+
+    # the smallest float type, which is promoted to the type of the input blocks
+    buffer = numpy.zeros(context, numpy.float32)
+    size   = 0
+    done   = 0
+
+    for block in blocks:
+
+        buffer = numpy.concatenate((buffer, block))
+        size  += len(block)
+
+        n = (len(buffer) - 2 * context) // q * q
+
+        if n > 0:
+
+            y = segment(buffer[:n + 2 * context])
+            done += len(y)
+            yield y
+
+            buffer = buffer[n:]
+
+    # the total number of output samples according to `resampy.resample`
+    total = int(size * float(samplerate) / float(origin))
+
+    if total > done:
 
-    progress  = tqdm.tqdm(total=100) \
-                if not opts.quiet else None
+        n = int(numpy.ceil((len(buffer) - context) / q)) * q
+        buffer = numpy.concatenate((buffer, numpy.zeros(n + 2 * context - len(buffer), buffer.dtype)))
 
-    samplerate    = 8000
-    x, samplerate = resample(src, samplerate)
+        yield segment(buffer)[:total - done]
 
-    reference  = 440
-    bandwidth  = 100, 4000
-    resolution = int(1200 / 25)
-    batchsize  = int(1 * samplerate)
-    numpeaks   = 3
+
+def parameters(opts: RemucsOptions) -> Dict[str, Any]:
+
+    # All values affecting the estimation, which also serve as the tuning cache key.
+    samplerate = 8000
+
+    return {
+        'samplerate': samplerate,
+        'reference':  440,
+        'bandwidth':  (100, 4000),
+        'resolution': int(1200 / 25),
+        'batchsize':  max(1, int(opts.batchsize * samplerate)),
+        'numpeaks':   3,
+        'decimation': max(1, opts.decimation),
+        'dtype':      str(numpy.dtype(opts.dtype)),
+        'confidence': opts.confidence,
+        'duration':   opts.duration,
+        'warmup':     10,
+    }
+
+
+def evaluate(freqs: NDArray, magns: NDArray, reference: float) -> Tuple[NDArray, NDArray]:
+
+    # the tuning frequency estimates of the strongest peaks and their weights
+    a = numpy.round(12 * numpy.log2(freqs / reference))
+    b = numpy.power(2, a / 12)
+    c = numpy.power(2, a / 6)
+
+    estimates = numpy.sum(freqs * b, axis=-1) / numpy.sum(c, axis=-1)
+    weights   = numpy.prod(magns, axis=-1)
+
+    assert numpy.all(numpy.isfinite(estimates))
+    assert numpy.all(numpy.isfinite(weights))
+
+    return estimates, weights
+
+
+def estimate(src: Path, opts: RemucsOptions,
+             samples: Union[Tuple[NDArray, int], None] = None) -> Iterator[Tuple[NDArray, NDArray]]:
+
+    params = parameters(opts)
+
+    samplerate = params['samplerate']
+    reference  = params['reference']
+    bandwidth  = params['bandwidth']
+    resolution = params['resolution']
+    batchsize  = params['batchsize']
+    numpeaks   = params['numpeaks']
+    decimation = params['decimation']
+
+    # pylint: disable=import-outside-toplevel
+    from qdft import QDFT
+    from qdft.fafe import QFAFE
 
     qdft = QDFT(samplerate=samplerate, bandwidth=bandwidth, resolution=resolution)
     fafe = QFAFE(qdft)
@@ -76,83 +297,228 @@ def analyze(src: Path, opts: RemucsOptions) -> Tuple[NDArray, NDArray]:
     # use qdft.latencies in the next qdft release
     latency = int(numpy.max(qdft.periods[0] - qdft.offsets))
 
-    oldsize = len(x)
-    newsize = int(numpy.ceil((latency + oldsize) / batchsize) * batchsize)
+    if samples is None and src.suffix == cache.RAW:
+        samples = cache.rawstem(src)
 
-    if oldsize < latency:
+    with contextlib.ExitStack() as stack:
 
-        s0 = int(numpy.round(oldsize / samplerate))
-        s1 = int(numpy.ceil(latency / samplerate))
+        # either decode the stem file or take the already decoded samples
+        if samples is None:
+            file   = stack.enter_context(soundfile.SoundFile(src))
+            origin = file.samplerate
+            frames = file.frames
+        else:
+            origin = samples[1]
+            frames = len(samples[0])
 
-        raise ValueError(
-            f'The audio file \"{src}\" length of {s0} seconds is too short, ' +
-            f'and needs to be at least {s1} seconds! ' +
-            'Otherwise reduce the analysis resolution.')
+        oldsize = int(frames * float(samplerate) / float(origin)) \
+                  if samplerate != origin else frames
 
-    x.resize(newsize)
+        if oldsize < latency:
 
-    batches   = numpy.arange(len(x)).reshape((-1, batchsize))
-    estimates = numpy.zeros(len(x), float)
-    weights   = numpy.zeros(len(x), float)
+            s0 = int(numpy.round(oldsize / samplerate))
+            s1 = int(numpy.ceil(latency / samplerate))
 
-    for index, batch in enumerate(batches):
+            raise ValueError(
+                f'The audio file \"{src}\" length of {s0} seconds is too short, ' +
+                f'and needs to be at least {s1} seconds! ' +
+                'Otherwise reduce the analysis resolution.')
 
-        dfts  = qdft.qdft(x[batch])
-        magns = numpy.abs(dfts)
-        freqs = fafe.hz(dfts)
+        # The input stem is decoded and resampled block by block in the background,
+        # while the QDFT of the previous batch is being computed.
+        blocksize = batchsize * origin // samplerate + 1
 
-        i = numpy.arange(len(batch))[..., None]
-        j = findpeaks(magns, numpeaks)
+        if samples is None:
+            blocks = file.blocks(blocksize, always_2d=True, dtype=params['dtype'])
+        else:
+            x      = numpy.reshape(samples[0], (frames, -1))
+            blocks = (x[i:i+blocksize].astype(params['dtype'], copy=False) for i in range(0, frames, blocksize))
 
-        magns = magns[i, j]
-        freqs = freqs[i, j]
+        inputs = (numpy.mean(block, axis=-1) for block in blocks)
+        inputs = resample_blocks(inputs, origin, samplerate)
+        inputs = itertools.chain(inputs, [numpy.zeros(latency)])
+        inputs = prefetch(reblock(inputs, batchsize))
 
-        a = numpy.round(12 * numpy.log2(freqs / reference))
-        b = numpy.power(2, a / 12)
-        c = numpy.power(2, a / 6)
+        # stop the background thread before the stem file is closed
+        stack.callback(inputs.close)
 
-        estimates[batch] = numpy.sum(freqs * b, axis=-1) / numpy.sum(c, axis=-1)
-        weights[batch]   = numpy.prod(magns, axis=-1)
+        # The QDFT needs to be computed sample by sample, but the frequency estimation only
+        # at every n-th sample after the first QDFT latency samples, since the tuning changes slowly.
+        position = 0
 
-        if progress is not None:
+        indices = numpy.empty((batchsize, numpeaks), int)
+        values  = numpy.empty((batchsize, numpeaks), float)
 
-            q = index / len(batches)
-            n = numpy.clip(numpy.ceil(100 * q), 0, 100)
-            m = numpy.clip(n - progress.n, 0, 100 - progress.n)
+        for batch in inputs:
 
-            progress.update(m)
+            start     = max(latency - position, (latency - position) % decimation)
+            position += len(batch)
 
-    estimates = estimates[latency:latency+oldsize]
-    weights   = weights[latency:latency+oldsize]
+            dfts  = qdft_decimated(qdft, batch, start, decimation)
 
-    assert numpy.all(numpy.isfinite(estimates))
-    assert numpy.all(numpy.isfinite(weights))
+            if len(dfts) == 0:
+                continue
 
-    if progress is not None:
-        progress.update(numpy.clip(100 - progress.n, 0, 100))
-        progress.close()
+            j, magns = findpeaks(numpy.abs(dfts), numpeaks, indices, values)
 
-    return estimates, weights
+            yield evaluate(numpy.take_along_axis(fafe.hz(dfts), j, axis=-1), magns, reference)
+
+
+def analyze(src: Path, opts: RemucsOptions, samples: Union[Tuple[NDArray, int], None] = None) -> Tuple[NDArray, NDArray]:
+
+    estimates = []
+    weights   = []
+
+    for batch in progress(src, opts, samples):
+
+        estimates.append(batch[0])
+        weights.append(batch[1])
+
+    return numpy.concatenate(estimates), numpy.concatenate(weights)
+
+
+def progress(src: Path, opts: RemucsOptions,
+             samples: Union[Tuple[NDArray, int], None] = None) -> Generator[Tuple[NDArray, NDArray], None, None]:
+
+    if opts.quiet:
+        yield from estimate(src, opts, samples)
+        return
+
+    click.echo(f'Analyzing {src.resolve()}')
+
+    total = length(src, samples)
+
+    params     = parameters(opts)
+    samplerate = params['samplerate'] / params['decimation']
+
+    with tqdm.tqdm(total=100) as meter:
+
+        size = 0
+
+        for batch in estimate(src, opts, samples):
+
+            size += len(batch[0])
+
+            n = numpy.clip(numpy.ceil(100 * size / samplerate / (total or 1)), 0, 100)
+            meter.update(numpy.clip(n - meter.n, 0, 100 - meter.n))
 
+            yield batch
 
-def howto_shift_pitch(src: Path, opts: RemucsOptions) -> float:
+        meter.update(numpy.clip(100 - meter.n, 0, 100))
 
-    estimates, weights = analyze(src, opts)
+
+def accumulate(hist: Dict[int, float], estimates: NDArray, weights: NDArray) -> Dict[int, float]:
 
     values = numpy.round(estimates).astype(int)
-    bounds = numpy.min(values), numpy.max(values)
+    bins, indices = numpy.unique(values, return_inverse=True)
+    sums = numpy.bincount(indices.ravel(), weights=weights, minlength=len(bins))
+
+    for value, weight in zip(bins.tolist(), sums.tolist()):
+        hist[value] = hist.get(value, 0) + weight
+
+    return hist
+
+
+def posterior(hist: Dict[int, float]) -> float:
+
+    total = sum(hist.values())
+
+    return max(hist.values()) / total if total > 0 else 0
+
+
+def finished(hist: Dict[int, float], size: int, samplerate: float, *,
+             confidence: Union[float, None],
+             duration: Union[float, None],
+             warmup: float) -> bool:
+
+    # either the maximum duration is analyzed or the winning bin is confident enough after the warmup
+    if duration is not None and size >= duration * samplerate:
+        return True
+
+    return confidence is not None and size >= warmup * samplerate and posterior(hist) >= confidence
+
+
+def histogram(batches: Generator[Tuple[NDArray, NDArray], None, None], samplerate: float, *,
+              confidence: Union[float, None] = None,
+              duration: Union[float, None] = None,
+              warmup: float = 0) -> Tuple[NDArray, NDArray, float]:
+
+    # The weighted histogram is accumulated batch by batch,
+    # instead of keeping all estimates of the entire stem in memory,
+    # and the analysis stops as soon as the winning bin is confident enough.
+    hist: Dict[int, float] = {}
+    size = 0
+
+    try:
+
+        for estimates, weights in batches:
+
+            if duration is not None:
+                estimates = estimates[:max(0, int(duration * samplerate) - size)]
+                weights   = weights[:len(estimates)]
+
+            accumulate(hist, estimates, weights)
+            size += len(estimates)
+
+            if finished(hist, size, samplerate, confidence=confidence, duration=duration, warmup=warmup):
+                break
+
+    finally:
+
+        batches.close()
+
+    assert len(hist) > 0
+
+    bounds = min(hist), max(hist)
     bins   = numpy.arange(bounds[0], bounds[1] + 1)
-    edges  = numpy.arange(bounds[0], bounds[1] + 2) - 0.5
-    hist   = numpy.histogram(values, bins=edges, weights=weights)
 
-    assert hist[0].shape == bins.shape
-    assert hist[1].shape == edges.shape
+    return bins, numpy.array([hist.get(value, 0) for value in bins.tolist()], float), size / samplerate
+
+
+def length(src: Path, samples: Union[Tuple[NDArray, int], None] = None) -> float:
+
+    if samples is None and src.suffix == cache.RAW:
+        samples = cache.rawstem(src)
+
+    return soundfile.info(src).duration if samples is None else len(samples[0]) / samples[1]
+
+
+def howto_shift_pitch(src: Path, opts: RemucsOptions, samples: Union[Tuple[NDArray, int], None] = None) -> float:
+
+    # The estimated reference frequency only depends on the stem content and analysis parameters,
+    # so keep it next to the stem to be able to retarget it without repeating the analysis,
+    # except for the in-memory stems, which are not necessarily written yet.
+    params = parameters(opts)
+    value  = cache.recall(src, 'tuning', params, opts.digest) if samples is None else None
+
+    if value is None:
+
+        bins, hist, seconds = histogram(progress(src, opts, samples), params['samplerate'] / params['decimation'],
+                                        confidence=params['confidence'],
+                                        duration=params['duration'],
+                                        warmup=params['warmup'])
+
+        value = {
+            'a4':       int(bins[numpy.argmax(hist)]),
+            'bins':     bins.tolist(),
+            'hist':     hist.tolist(),
+            'duration': seconds,
+        }
+
+        if samples is None:
+            cache.remember(src, 'tuning', params, opts.digest, value)
+
+    elif not opts.quiet:
+
+        click.echo(f'Reusing estimated tuning of {src.resolve()}')
 
-    a4     = bins[numpy.argmax(hist[0])]
+    a4     = value['a4']
     factor = opts.a4 / a4
     cents  = round(1200 * numpy.log2(factor))
 
     if not opts.quiet:
+        total = length(src, samples)
+        click.echo(f'Estimated tuning reference {a4} Hz from {value["duration"]:.1f} of {total:.1f} seconds')
         click.echo(f'Estimated pitch shifting factor \"-p 0{cents:+d}\" cents (from {a4} Hz to {opts.a4} Hz)')
 
     return factor
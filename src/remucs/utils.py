@@ -1,8 +1,16 @@
 from os import PathLike
-from typing import Union
+from typing import Any, Callable, Generator, Iterable, Iterator, TypeVar, Union
 
+import contextlib
 import hashlib
+import os
+import queue
 import re
+import threading
+
+from remucs import profiling
+
+T = TypeVar('T')
 
 
 def semitone(value: str) -> float:
@@ -29,7 +37,130 @@ def kilo(value: str) -> int:
     return int(value)
 
 
+def bytesize(value: str) -> int:
+
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    unit  = value[-1:].lower()
+
+    if unit in units:
+        return int(float(value[:-1]) * units[unit])
+
+    return int(value)
+
+
 def filehash(file: Union[str, PathLike], digest: str) -> str:
 
+    with profiling.span('filehash', file=str(file), digest=digest) as record:
+
+        if record is not None:
+            record['read'] = os.path.getsize(file) if digest != 'sampled' else min(os.path.getsize(file), 16 << 20)
+
+        if digest == 'sampled':
+            return samplehash(file)
+
+        with open(file, 'rb') as stream:
+            return hashlib.file_digest(stream, digest).hexdigest()
+
+
+def samplehash(file: Union[str, PathLike], blocksize: int = 1 << 20, blocks: int = 16) -> str:
+
+    # Hashes the file size and a fixed number of evenly spaced blocks instead of the whole file,
+    # which is only sufficient to detect modifications of entire audio files, not single bytes.
+    size   = os.path.getsize(file)
+    digest = hashlib.blake2b(str(size).encode())
+
     with open(file, 'rb') as stream:
-        return hashlib.file_digest(stream, digest).hexdigest()
+
+        if size <= blocksize * blocks:
+
+            digest.update(stream.read())
+
+        else:
+
+            for offset in range(blocks):
+
+                stream.seek(offset * (size - blocksize) // (blocks - 1))
+                digest.update(stream.read(blocksize))
+
+    return digest.hexdigest()
+
+
+def prefetch(items: Iterable[T], size: int = 2) -> Generator[T, None, None]:
+
+    # Produces the next items in a background thread while the current one is being consumed,
+    # so that the producer is at most the specified number of items ahead of the consumer.
+    buffer: queue.Queue = queue.Queue(size)
+    cancel = threading.Event()
+    finish = object()
+
+    def put(item):
+        while not cancel.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((finish, None))
+        except BaseException as error:  # pylint: disable=broad-exception-caught
+            put((finish, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is finish:
+                return
+            yield item
+    finally:
+        cancel.set()
+        thread.join()
+
+
+@contextlib.contextmanager
+def writeback(consume: Callable[[T], Any], size: int = 2) -> Iterator[Callable[[T], None]]:
+
+    # Consumes the items in a background thread while the next one is being produced,
+    # so that the producer is blocked only if the specified number of items is still pending.
+    buffer: queue.Queue = queue.Queue(size)
+    errors: list = []
+    finish = object()
+
+    def consumer():
+        while True:
+            item = buffer.get()
+            if item is finish:
+                return
+            if errors:
+                continue
+            try:
+                consume(item)
+            except BaseException as error:  # pylint: disable=broad-exception-caught
+                errors.append(error)
+
+    def produce(item: T):
+        if errors:
+            raise errors[0]
+        buffer.put(item)
+
+    thread = threading.Thread(target=consumer, daemon=True)
+    thread.start()
+
+    try:
+        yield produce
+    finally:
+        buffer.put(finish)
+        thread.join()
+
+    if errors:
+        raise errors[0]
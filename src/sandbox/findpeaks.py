@@ -0,0 +1,51 @@
+# pylint: disable=import-error
+
+import timeit
+
+import numpy as np
+
+from remucs.tuning import findpeaks, findpeaks_kernel, findpeaks_numpy
+
+
+def findpeaks_legacy(x, n):
+
+    a = x[..., 0:-3]
+    y = x[..., 1:-2]
+    b = x[..., 2:-1]
+
+    i = (y > a) & (y > b)
+    j = np.argpartition(np.negative(y * i), n)[..., :n] + 1
+
+    k = np.arange(len(x))[..., None]
+
+    return j, x[k, j]
+
+
+def main():
+
+    rows, cols, n = 8000, 232, 3
+
+    x = np.abs(np.random.default_rng(0).standard_normal((rows, cols)))
+
+    indices = np.empty((rows, n), int)
+    values  = np.empty((rows, n), float)
+
+    # warmup the jit compilation
+    findpeaks(x, n, indices, values)
+
+    tests = {
+        'legacy': lambda: findpeaks_legacy(x, n),
+        'numpy': lambda: findpeaks_numpy(x, n, indices, values),
+        'numba': lambda: findpeaks_kernel()(x, n, indices, values),
+    }
+
+    for name, test in tests.items():
+
+        seconds = min(timeit.repeat(test, number=10, repeat=5)) / 10
+
+        print(f'{name:<8} {seconds * 1e3:8.3f} ms per second of 8 kHz audio')
+
+
+if __name__ == '__main__':
+
+    main()
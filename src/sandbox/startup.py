@@ -0,0 +1,45 @@
+# pylint: disable=import-error
+
+import operator
+import subprocess
+import sys
+
+# the modules, which are expected to be imported only on demand
+HEAVY = ['torch', 'demucs', 'qdft', 'resampy', 'numba']
+
+
+def importtime(module):
+
+    # Each line of the `-X importtime` report has the form
+    # "import time: self [us] | cumulative | imported package".
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+
+    times = {}
+
+    for line in result.stderr.splitlines():
+
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+
+        times[name] = max(times.get(name, 0), int(cumulative))
+
+    return times
+
+
+def main():
+
+    for module in ['remucs', 'remucs.__main__', 'remucs.synthesis', 'remucs.tuning', 'remucs.analysis']:
+
+        times = min((importtime(module) for _ in range(5)), key=operator.itemgetter(module))
+        heavy = [name for name in times if name.split('.')[0] in HEAVY]
+
+        print(f'{module:<18} {times[module] * 1e-3:8.1f} ms', *(['including', *sorted(set(name.split('.')[0] for name in heavy))] if heavy else []))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,94 @@
+# pylint: disable=import-error
+
+from pathlib import Path
+from typing import List
+
+from test_utils import time, wave
+
+import pytest
+import soundfile
+
+import remucs
+
+from remucs import analysis, cache
+from remucs.batch import batch
+
+
+@pytest.fixture(name='files')
+def create_test_files(tmp_path: Path) -> List[Path]:
+
+    sr = 44100
+    t  = time(1, sr)
+
+    files = []
+
+    # distinct files in order to get distinct cache entries
+    for i in range(4):
+        file = tmp_path / f'test{i}.wav'
+        soundfile.write(file, 0.2 * wave([500 + 100 * i, 2000], t), sr)
+        files.append(file)
+
+    return files
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_batch(files: List[Path], tmp_path: Path, jobs: int):
+
+    missing = tmp_path / 'missing.wav'
+    broken  = tmp_path / 'broken.wav'
+
+    broken.write_text('nothing to hear')
+
+    # the failing files don't affect the remaining ones
+    errors = batch([missing] + files[:2] + [broken] + files[2:], tmp_path, remucs.RemucsOptions(), jobs=jobs)
+
+    assert list(errors) == [missing, broken]
+    assert isinstance(errors[missing], FileNotFoundError)
+
+    assert all(file.with_suffix('.remucs.wav').is_file() for file in files)
+    assert not broken.with_suffix('.remucs.wav').exists()
+
+
+def test_evict(files: List[Path], tmp_path: Path):
+
+    # Each entry exceeds the cache budget, so that every separation evicts the previous entries,
+    # except for those which are still waiting to be remixed in the other processes.
+    errors = batch(files, tmp_path, remucs.RemucsOptions(pitch=1.3, cache=1), jobs=2)
+
+    assert errors == {}
+    assert all(file.with_suffix('.remucs.wav').is_file() for file in files)
+
+    assert not cache.PINNED
+
+
+def test_separator(files: List[Path], tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+
+    if analysis.backend() != 'demucs.api':
+        pytest.skip('requires demucs.api')
+
+    import demucs.api  # pylint: disable=import-outside-toplevel
+
+    separator = demucs.api.Separator
+    instances = []
+
+    def create(**kwargs):
+        instances.append(separator(**kwargs))
+        return instances[-1]
+
+    monkeypatch.setattr(demucs.api, 'Separator', create)
+
+    analysis.close()
+
+    # the model is loaded once for all files
+    assert batch(files[:2], tmp_path) == {}
+    assert len(instances) == 1
+    assert list(analysis.SEPARATORS.values()) == instances
+
+    analysis.close()
+    assert not analysis.SEPARATORS
+
+    # and loaded again after being released
+    assert batch(files[2:], tmp_path) == {}
+    assert len(instances) == 2
+
+    analysis.close()
@@ -0,0 +1,223 @@
+# pylint: disable=import-error
+
+from pathlib import Path
+
+import json
+import os
+
+import numpy
+import pytest
+
+from click.testing import CliRunner
+
+from remucs import cache, utils
+from remucs.__main__ import main
+
+
+def create(root: Path, digest: str, access: float, size: int = 1000) -> Path:
+
+    entry = cache.locate(root, digest, '4.1.0', 'htdemucs')
+    entry.mkdir(parents=True)
+
+    (entry / 'other.wav').write_bytes(bytes(size))
+    cache.touch(entry, Path(f'{digest}.wav'))
+
+    os.utime(entry / cache.ENTRY, (access, access))
+
+    # the digest of the corresponding track file
+    meta = root / cache.FILES / f'{digest}.json'
+    meta.parent.mkdir(parents=True, exist_ok=True)
+    meta.write_text(json.dumps({'hash': digest}))
+
+    return entry
+
+
+def test_entries(tmp_path: Path):
+
+    a = create(tmp_path, 'a', 1)
+    c = create(tmp_path, 'c', 3)
+    b = create(tmp_path, 'b', 2)
+
+    entries = cache.entries(tmp_path)
+
+    # most recently used first
+    assert [entry.path for entry in entries] == [c, b, a]
+    assert [entry.files for entry in entries] == [['c.wav'], ['b.wav'], ['a.wav']]
+    assert all(entry.size > 1000 for entry in entries)
+
+    # skip the partially written or truncated entries
+    (b / cache.ENTRY).write_text('{"digest": "b"')
+
+    assert [entry.path for entry in cache.entries(tmp_path)] == [c, a]
+
+
+def test_evict(tmp_path: Path):
+
+    a = create(tmp_path, 'a', 1)
+    b = create(tmp_path, 'b', 2)
+    c = create(tmp_path, 'c', 3)
+
+    size = {entry.path: entry.size for entry in cache.entries(tmp_path)}
+
+    assert not cache.evict(tmp_path, None)
+    assert not cache.evict(tmp_path, sum(size.values()))
+
+    # the least recently used entry is dropped first, unless it is to be kept
+    dropped = cache.evict(tmp_path, size[b] + size[c], keep=[a])
+
+    assert [entry.path for entry in dropped] == [b]
+    assert a.is_dir() and not b.exists() and c.is_dir()
+
+    # also the empty parent directories and the orphaned file digest
+    assert not (tmp_path / cache.STEMS / 'b').exists()
+    assert not (tmp_path / cache.FILES / 'b.json').exists()
+    assert (tmp_path / cache.FILES / 'a.json').is_file()
+
+    dropped = cache.evict(tmp_path, size[c])
+
+    assert [entry.path for entry in dropped] == [a]
+    assert [entry.path for entry in cache.entries(tmp_path)] == [c]
+
+
+def test_pinned(tmp_path: Path):
+
+    a = create(tmp_path, 'a', 1)
+    b = create(tmp_path, 'b', 2)
+
+    cache.pin(a)
+
+    try:
+        dropped = cache.evict(tmp_path, 0)
+    finally:
+        cache.unpin(a)
+
+    assert [entry.path for entry in dropped] == [b]
+    assert not cache.PINNED
+
+
+def test_cli(tmp_path: Path):
+
+    root = tmp_path / '.remucs'
+
+    create(root, 'a' * 64, 1)
+    create(root, 'b' * 64, 2)
+
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['cache', 'list', '-d', str(tmp_path)])
+
+    assert result.exit_code == 0
+    assert [line.split()[0] for line in result.output.splitlines()] == ['b' * 16, 'a' * 16]
+
+    result = runner.invoke(main, ['cache', 'stats', '-d', str(tmp_path)])
+
+    assert result.exit_code == 0
+    assert 'Entries  2' in result.output
+    assert 'Tracks   2' in result.output
+
+    result = runner.invoke(main, ['cache', 'prune', '-d', str(tmp_path), '-s', '0'])
+
+    assert result.exit_code == 0
+    assert len(result.output.splitlines()) == 2
+    assert not cache.entries(root)
+    assert not list((root / cache.FILES).glob('*.json'))
+
+
+@pytest.fixture(name='hashes')
+def count_file_hashes(monkeypatch: pytest.MonkeyPatch) -> list:
+
+    hashes = []
+
+    def filehash(file, digest):
+        hashes.append(file)
+        return utils.filehash(file, digest)
+
+    monkeypatch.setattr(cache, 'filehash', filehash)
+
+    return hashes
+
+
+def test_filedigest(tmp_path: Path, hashes: list):
+
+    file = tmp_path / 'test.wav'
+    file.write_bytes(bytes(1000))
+
+    digest = cache.filedigest(tmp_path, file, 'sha256')
+
+    # the digest is reused as long as the file stat remains the same
+    assert cache.filedigest(tmp_path, file, 'sha256') == digest
+    assert len(hashes) == 1
+
+    os.utime(file, ns=(0, 0))
+
+    assert cache.filedigest(tmp_path, file, 'sha256') == digest
+    assert len(hashes) == 2
+
+    file.write_bytes(bytes(1001))
+
+    assert cache.filedigest(tmp_path, file, 'sha256') != digest
+    assert len(hashes) == 3
+
+
+def test_sidecar(tmp_path: Path, hashes: list):
+
+    file = tmp_path / 'other.wav'
+    file.write_bytes(bytes(1000))
+
+    assert cache.recall(file, 'test', {'a': 1}, 'sha256') is None
+
+    cache.remember(file, 'test', {'a': 1}, 'sha256', {'b': 2})
+
+    assert cache.recall(file, 'test', {'a': 1}, 'sha256') == {'b': 2}
+    assert cache.recall(file, 'test', {'a': 2}, 'sha256') is None
+
+    count = len(hashes)
+
+    # the refreshed signature of the unchanged content is kept as well
+    os.utime(file, ns=(0, 0))
+
+    assert cache.recall(file, 'test', {'a': 1}, 'sha256') == {'b': 2}
+    assert cache.recall(file, 'test', {'a': 1}, 'sha256') == {'b': 2}
+    assert len(hashes) == count + 1
+
+    file.write_bytes(bytes(1001))
+
+    assert cache.recall(file, 'test', {'a': 1}, 'sha256') is None
+
+
+def test_samplehash(tmp_path: Path):
+
+    blocksize = 1000
+    blocks    = 4
+
+    rng = numpy.random.default_rng(0)
+
+    small = tmp_path / 'small.wav'
+    large = tmp_path / 'large.wav'
+
+    x = rng.bytes(blocksize * blocks)
+    y = rng.bytes(blocksize * blocks * 10)
+
+    small.write_bytes(x)
+    large.write_bytes(y)
+
+    # the small files are hashed entirely
+    a = utils.samplehash(small, blocksize, blocks)
+    small.write_bytes(x[:-1] + bytes(1))
+    assert utils.samplehash(small, blocksize, blocks) != a
+
+    # whereas the large ones only at evenly spaced blocks including the first and the last one
+    b = utils.samplehash(large, blocksize, blocks)
+    assert utils.samplehash(large, blocksize, blocks) == b
+
+    large.write_bytes(y[:-1] + bytes(1))
+    assert utils.samplehash(large, blocksize, blocks) != b
+
+    large.write_bytes(y[:blocksize * 2] + bytes(1) + y[blocksize * 2 + 1:])
+    assert utils.samplehash(large, blocksize, blocks) == b
+
+    # and their size
+    large.write_bytes(y + bytes(1))
+    assert utils.samplehash(large, blocksize, blocks) != b
+
+    assert utils.filehash(large, 'sampled') != utils.filehash(large, 'sha256')
@@ -0,0 +1,99 @@
+# pylint: disable=import-error
+
+from pathlib import Path
+
+import numpy
+import pytest
+import soundfile
+import stftpitchshift
+
+from remucs.pitch import PitchShifter, shiftpitch_blocks, shiftpitch_file
+from remucs.synthesis import shiftpitch
+
+SR = 44100
+
+
+def reference(x, factor, quefrency):
+
+    shifter = stftpitchshift.StftPitchShift(framesize=4096, hopsize=1024, samplerate=SR)
+
+    return numpy.stack([shifter.shiftpitch(x[:, i], factors=factor, quefrency=quefrency, normalization=True)
+                        for i in range(x.shape[-1])], axis=-1)
+
+
+@pytest.mark.parametrize('factor,quefrency,blocksize,channels', [
+    (1.5,        0,    1000,   1),
+    (0.7,        1e-3, 4096,   2),
+    (1.2,        1e-3, 100000, 2),
+    ([0.5, 1.5], 0,    3000,   3),
+])
+def test_shifter(factor: float, quefrency: float, blocksize: int, channels: int):
+
+    x = numpy.random.default_rng(0).uniform(-1, +1, (SR, channels))
+
+    shifter = PitchShifter(samplerate=SR, factor=factor, quefrency=quefrency, framesize=4096, hopsize=1024, chunksize=3)
+
+    y = [shifter.process(x[i:i+blocksize]) for i in range(0, len(x), blocksize)]
+    y = numpy.concatenate(y + [shifter.flush()])
+
+    assert y.shape == x.shape
+    assert numpy.array_equal(y, reference(x, factor, quefrency))
+
+
+def test_float32():
+
+    t = numpy.arange(SR) / SR
+    x = numpy.stack([numpy.sin(2 * numpy.pi * f * t) for f in [440, 1000]], axis=-1) / 2
+
+    shifter = PitchShifter(samplerate=SR, factor=1.5, quefrency=0, framesize=4096, hopsize=1024)
+
+    y = numpy.concatenate((shifter.process(x.astype(numpy.float32)), shifter.flush()))
+
+    assert y.dtype == numpy.float32
+    assert numpy.allclose(y, reference(x, 1.5, 0), rtol=0, atol=1e-3)
+
+
+def test_shiftpitch():
+
+    x = numpy.random.default_rng(0).uniform(-1, +1, (SR, 2))
+    y = shiftpitch(x, samplerate=SR, factor=1.5, quefrency=1e-3, framesize=4096, hopsize=1024)
+
+    assert numpy.array_equal(y, reference(x, 1.5, 1e-3))
+
+
+def test_blocks():
+
+    x = numpy.random.default_rng(0).uniform(-1, +1, (SR + 123, 2))
+    n = 1000
+
+    y = shiftpitch_blocks((x[i:i+n] for i in range(0, len(x), n)),
+        blocksize=n, samplerate=SR, factor=1.5, quefrency=1e-3, framesize=4096, hopsize=1024)
+    y = list(y)
+
+    z = reference(x, 1.5, 1e-3)
+
+    assert all(len(block) == n for block in y[:-1])
+    assert numpy.array_equal(numpy.concatenate(y), z)
+
+
+def test_file(tmp_path: Path):
+
+    src = tmp_path / 'test.wav'
+    dst = tmp_path / 'test.npy'
+
+    x = numpy.random.default_rng(0).uniform(-1, +1, (SR + 123, 2))
+    soundfile.write(src, x, SR, subtype='DOUBLE')
+
+    y = numpy.lib.format.open_memmap(dst, mode='w+', shape=x.shape)
+    del y
+
+    for channel in [0, 1]:
+        shiftpitch_file(src, dst, channel,
+            blocksize=1000, samplerate=SR, factor=0.8, quefrency=0, framesize=4096, hopsize=1024)
+
+    assert numpy.array_equal(numpy.load(dst), reference(x, 0.8, 0))
+
+    shiftpitch_file(src, dst,
+        blocksize=1000, samplerate=SR, factor=1.2, quefrency=0, framesize=4096, hopsize=1024)
+
+    assert numpy.array_equal(numpy.load(dst), reference(x, 1.2, 0))
@@ -1,16 +1,26 @@
 # pylint: disable=import-error
 
+from concurrent.futures import Future
 from dataclasses import dataclass
 from pathlib import Path
 from typing import List
 
 from test_utils import find, freqs, isless, issame, time, wave
 
+import importlib
+import threading
+
 import numpy
 import pytest
 import soundfile
 
 import remucs
+import remucs.profiling
+import remucs.server
+
+from remucs import analysis
+from remucs.analysis import Stems
+from remucs.synthesis import lookup, schedule, synthesize
 
 DEBUG = False
 
@@ -103,7 +113,7 @@ def test_debug(session: Session):
     data = session.data
 
     src = session.src
-    dst = data / '.remucs' / src.stem / 'htdemucs' / 'other.wav'
+    dst = next((data / '.remucs' / 'stems').glob('*/*/htdemucs/other.wav'))
 
     sr = session.sr
     f  = session.f
@@ -192,3 +202,320 @@ def test_balance_right(session: Session):
     assert isless(db[0, 1], -40)
     assert isless(db[1, 0], -40)
     assert issame(db[1, 1],  0)
+
+
+def test_blocks(session: Session):
+
+    db = probe(session, norm=True, gain=[1, 1, 0.5, 1], blocksize=1000)
+    print('y blocks', db[0], db[1])
+
+    assert issame(db[0, 0],  0)
+    assert isless(db[0, 1], -40)
+    assert isless(db[1, 0], -40)
+    assert issame(db[1, 1],  0)
+
+
+def test_float32(session: Session):
+
+    db = probe(session, norm=True, gain=[1, 1, 0.5, 1], dtype='float32')
+    print('y float32', db[0], db[1])
+
+    assert issame(db[0, 0],  0)
+    assert isless(db[0, 1], -40)
+    assert isless(db[1, 0], -40)
+    assert issame(db[1, 1],  0)
+
+
+def test_memory(session: Session):
+
+    db = probe(session, memory=True, store=False)
+    print('y memory', db[0], db[1])
+
+    assert issame(db[0, 0],  0)
+    assert isless(db[0, 1], -40)
+    assert isless(db[1, 0], -40)
+    assert issame(db[1, 1],  0)
+
+    assert not (session.data / '.remucs' / '.remucs').exists()
+
+
+def test_memory_error(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+
+    file = tmp_path / 'x.wav'
+    soundfile.write(file, numpy.zeros((100, 2)), 44100)
+
+    store = Future()
+    store.set_exception(OSError('store'))
+
+    def remix(*args):
+        raise ValueError('remix')
+
+    # the module is shadowed by the function of the same name
+    module = importlib.import_module('remucs.remucs')
+
+    monkeypatch.setattr(module, 'extract', lambda *args: Stems(path=tmp_path, samplerate=44100, samples={}, store=store))
+    monkeypatch.setattr(module, 'remix', remix)
+
+    # the failing store does not mask the remix error
+    with pytest.raises(ValueError):
+        module.remucs(file, tmp_path, remucs.RemucsOptions(memory=True, quiet=True))
+
+
+def test_raw(session: Session):
+
+    db = probe(session, raw=True)
+    print('y raw', db[0], db[1])
+
+    assert issame(db[0, 0],  0)
+    assert isless(db[0, 1], -40)
+    assert isless(db[1, 0], -40)
+    assert issame(db[1, 1],  0)
+
+
+def test_server(session: Session):
+
+    data = session.data
+
+    src = session.src
+    dst = session.dst
+
+    opts = remucs.RemucsOptions(quiet=True)
+    sock = remucs.server.address(data, opts)
+
+    assert remucs.server.submit([src], data, opts) is None
+
+    stop   = threading.Event()
+    server = threading.Thread(target=remucs.server.serve, args=(data, opts), kwargs={'stop': stop}, daemon=True)
+    server.start()
+
+    try:
+
+        for _ in range(100):
+            client = remucs.server.connect(sock)
+            if client is not None:
+                client.close()
+                break
+            threading.Event().wait(0.1)
+
+        dst.unlink()
+
+        errors = remucs.server.submit([src], data, opts)
+        assert errors == {}
+        assert dst.is_file()
+
+        dst.unlink()
+
+        # also in the parallel processes of the daemon
+        errors = remucs.server.submit([src], data, opts, jobs=2)
+        assert errors == {}
+        assert dst.is_file()
+
+    finally:
+
+        stop.set()
+        server.join(10)
+        sock.unlink(missing_ok=True)
+
+    assert not server.is_alive()
+    assert remucs.server.submit([src], data, opts) is None
+
+
+def test_window(tmp_path: Path):
+
+    rng = numpy.random.default_rng(0)
+
+    total     = 10000
+    window    = 3000
+    crossfade = 500
+
+    x = rng.uniform(-1, 1, (total, 2)).astype(numpy.float32)
+    y = {'other': numpy.zeros_like(x)}
+
+    # The identity separation of the overlapping windows reconstructs the input,
+    # exactly except for the float32 rounding of the crossfade.
+    end = 0
+
+    for start in range(0, total - crossfade, window - crossfade):
+        end = analysis.crossfade_window(y, {'other': x[start:start+window]}, start, end)
+
+    assert end == total
+    numpy.testing.assert_array_max_ulp(y['other'], x, maxulp=1)
+
+    # linear crossfade from the previous window into the next one
+    z = {'other': numpy.zeros_like(x)}
+
+    end = analysis.crossfade_window(z, {'other': numpy.zeros((window, 2), numpy.float32)}, 0, 0)
+    end = analysis.crossfade_window(z, {'other': numpy.ones((window, 2), numpy.float32)}, window - crossfade, end)
+
+    ramp = numpy.linspace(0, 1, crossfade + 2, dtype=numpy.float32)[1:-1, None]
+
+    assert end == 2 * window - crossfade
+    assert numpy.array_equal(z['other'][window-crossfade:window], numpy.broadcast_to(ramp, (crossfade, 2)))
+    assert numpy.all(z['other'][window:end] == 1) and numpy.all(z['other'][end:] == 0)
+
+    # The raw stems are rescaled in place, if clipping, and moved to the destination.
+    for scale in [0.5, 2]:
+
+        temp = tmp_path / f'.other{scale}.partial.npy'
+        dst  = tmp_path / f'other{scale}.npy'
+
+        samples = numpy.lib.format.open_memmap(temp, mode='w+', dtype=numpy.float32, shape=x.shape)
+        samples[:] = x * scale
+
+        analysis.finalize_window(samples, temp, dst, 44100, 4096)
+
+        peak = numpy.max(numpy.abs(x * scale))
+
+        assert not temp.exists()
+        assert numpy.array_equal(numpy.load(dst), x * scale if scale < 1 else x * scale * numpy.float32(1 / (1.01 * peak)))
+
+    if analysis.backend() != 'demucs.api':
+        return
+
+    # whereas the encoded stems are the same as the ones separated at once
+    temp = tmp_path / '.other.partial.npy'
+
+    samples = numpy.lib.format.open_memmap(temp, mode='w+', dtype=numpy.float32, shape=x.shape)
+    samples[:] = x * 2
+
+    analysis.save_demucs_api({'other': x * 2}, 44100, {'other': tmp_path / 'once.wav'}, remucs.RemucsOptions(quiet=True))
+    analysis.finalize_window(samples, temp, tmp_path / 'windows.wav', 44100, 4096)
+
+    assert soundfile.info(tmp_path / 'windows.wav').subtype == 'PCM_16'
+    assert (tmp_path / 'windows.wav').read_bytes() == (tmp_path / 'once.wav').read_bytes()
+
+
+def test_windows(session: Session, tmp_path: Path):
+
+    src = session.src
+    dst = session.dst
+
+    dst.unlink()
+
+    (tmp_path / 'once').mkdir()
+    (tmp_path / 'windows').mkdir()
+
+    remucs.remucs(src, tmp_path / 'once', remucs.RemucsOptions(quiet=True))
+    remucs.remucs(src, tmp_path / 'windows', remucs.RemucsOptions(quiet=True, window=0.4, crossfade=0.1, workers=2))
+
+    assert dst.is_file()
+
+    # Only the cached stem format is expected to match, since a real network separates each window differently.
+    x = next((tmp_path / 'once' / '.remucs' / 'stems').glob('*/*/htdemucs/other.wav'))
+    y = next((tmp_path / 'windows' / '.remucs' / 'stems').glob('*/*/htdemucs/other.wav'))
+
+    x = soundfile.info(x)
+    y = soundfile.info(y)
+
+    assert (x.format, x.subtype, x.samplerate, x.frames) == (y.format, y.subtype, y.samplerate, y.frames)
+
+
+def test_complement(session: Session):
+
+    db = probe(session, gain=[1, 1, 1, 0], complement=True)
+    print('y complement', db[0], db[1])
+
+    assert issame(db[0, 0],  0)
+    assert isless(db[0, 1], -40)
+    assert isless(db[1, 0], -40)
+    assert issame(db[1, 1],  0)
+
+
+@pytest.mark.parametrize('reuse', [False, True])
+def test_merge(tmp_path: Path, reuse: bool):
+
+    sr = 44100
+    t  = time(1, sr)
+
+    # distinct tones in each stem, which are expected at 1.5 times the frequency after pitch shifting
+    f = {'bass': [100, 150], 'drums': [5000, 6000], 'other': [1000, 2000], 'vocals': [3000, 4000]}
+
+    (tmp_path / 'htdemucs').mkdir()
+
+    for stem, hz in f.items():
+        soundfile.write(tmp_path / 'htdemucs' / f'{stem}.wav', 0.2 * wave(hz, t), sr, subtype='FLOAT')
+
+    x = tmp_path / 'x.wav'
+    y = tmp_path / 'y.wav'
+
+    synthesize(x, tmp_path, remucs.RemucsOptions(pitch=1.5, reuse=reuse))
+    synthesize(y, tmp_path, remucs.RemucsOptions(pitch=1.5, reuse=reuse, merge=True))
+
+    x = numpy.array(soundfile.read(x)[0])
+    y = numpy.array(soundfile.read(y)[0])
+
+    assert x.shape == y.shape
+
+    dbx, hz = freqs(x, sr)
+    dby, _  = freqs(y, sr)
+
+    for stem in ['bass', 'other', 'vocals']:
+        idx = find(hz, numpy.multiply(f[stem], 1.5))
+        assert issame(dbx[idx[0], 0], dby[idx[0], 0])
+        assert issame(dbx[idx[1], 1], dby[idx[1], 1])
+
+    idx = find(hz, f['drums'])
+    assert issame(dbx[idx[0], 0], dby[idx[0], 0])
+    assert issame(dbx[idx[1], 1], dby[idx[1], 1])
+
+
+def test_source(tmp_path: Path):
+
+    sr = 44100
+    t  = time(1, sr)
+
+    opts = remucs.RemucsOptions(pitch=1.5, reuse=True)
+    keys = []
+
+    # the cached renders and shifted stems of differently encoded stems must not be mixed up
+    for subtype in ['PCM_16', 'FLOAT']:
+
+        data = tmp_path / subtype
+        (data / 'htdemucs').mkdir(parents=True)
+
+        src = [data / 'htdemucs' / f'{stem}.wav' for stem in opts.stems]
+
+        for stem in src:
+            soundfile.write(stem, 0.2 * wave([100, 150], t), sr, subtype=subtype)
+
+        synthesis = schedule(data, src, opts)
+
+        keys.append([lookup(tmp_path / 'x.wav', data, opts, synthesis).name] + [path.name for path in synthesis.shifted])
+
+    assert not set(keys[0]) & set(keys[1])
+
+
+def test_profile(session: Session):
+
+    records = []
+
+    with remucs.profiling.profile(records.append):
+        probe(session, pitch=2)
+
+    stages = set(record['stage'] for record in records)
+
+    assert {'analyze', 'synthesize', 'shiftpitch', 'write'} <= stages
+    assert all(record['wall'] >= 0 and record['maxrss'] > 0 for record in records)
+
+    count = len(records)
+    probe(session)
+
+    assert len(records) == count
+
+
+def test_skip(tmp_path: Path):
+
+    sr = 44100
+    t  = time(1, sr)
+
+    (tmp_path / 'htdemucs').mkdir()
+
+    # the stems with zero gain are not even expected to exist
+    for stem in ['bass', 'other', 'vocals']:
+        soundfile.write(tmp_path / 'htdemucs' / f'{stem}.wav', 0.2 * wave([1000, 2000], t), sr)
+
+    synthesize(tmp_path / 'y.wav', tmp_path, remucs.RemucsOptions(gain=[1, 0, 1, 1]))
+
+    y = numpy.array(soundfile.read(tmp_path / 'y.wav')[0])
+
+    assert y.shape == (len(t), 2)
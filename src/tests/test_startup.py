@@ -0,0 +1,20 @@
+# pylint: disable=import-error
+
+import subprocess
+import sys
+
+import pytest
+
+HEAVY = ['torch', 'demucs', 'qdft', 'resampy', 'numba']
+
+
+@pytest.mark.parametrize('module', ['remucs', 'remucs.__main__', 'remucs.synthesis', 'remucs.tuning'])
+def test_startup(module):
+
+    code = f'import sys, {module}; print(*sorted(set(name.split(".")[0] for name in sys.modules)))'
+
+    modules = subprocess.run([sys.executable, '-c', code],
+                             capture_output=True, text=True, check=True).stdout.split()
+
+    assert module.split('.')[0] in modules
+    assert not set(HEAVY) & set(modules)
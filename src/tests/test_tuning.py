@@ -0,0 +1,141 @@
+# pylint: disable=import-error
+
+from pathlib import Path
+
+import numpy
+import pytest
+import resampy
+import soundfile
+
+from remucs import tuning
+from remucs.options import RemucsOptions
+from remucs.tuning import analyze, findpeaks, findpeaks_numpy, histogram, howto_shift_pitch, qdft_decimated, resample_blocks
+
+
+def test_findpeaks():
+
+    x = numpy.abs(numpy.random.default_rng(0).standard_normal((1000, 32)))
+    n = 3
+
+    i = numpy.empty((len(x), n), int)
+    v = numpy.empty((len(x), n), float)
+
+    findpeaks_numpy(x, n, i, v)
+    j, w = findpeaks(x, n, numpy.empty((len(x) + 10, n), int), numpy.empty((len(x) + 10, n), float))
+
+    assert numpy.array_equal(numpy.sort(i, axis=-1), numpy.sort(j, axis=-1))
+    assert numpy.array_equal(numpy.sort(v, axis=-1), numpy.sort(w, axis=-1))
+    assert numpy.array_equal(numpy.take_along_axis(x, j, axis=-1), w)
+
+
+@pytest.mark.parametrize('blocksize', [1000, 4410, 44100])
+def test_resample(blocksize: int):
+
+    x = numpy.random.default_rng(0).uniform(-1, +1, 100003)
+
+    y = resample_blocks((x[i:i+blocksize] for i in range(0, len(x), blocksize)), 44100, 8000)
+    y = numpy.concatenate(list(y))
+
+    z = resampy.resample(x, 44100, 8000)
+
+    assert y.shape == z.shape
+    assert numpy.allclose(y, z, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('decimation', [1, 3, 16])
+def test_qdft(decimation: int):
+
+    from qdft import QDFT  # pylint: disable=import-outside-toplevel
+
+    x = numpy.random.default_rng(0).uniform(-1, +1, 3000)
+
+    a = QDFT(samplerate=8000, bandwidth=(100, 4000), resolution=48)
+    b = QDFT(samplerate=8000, bandwidth=(100, 4000), resolution=48)
+
+    # only the kept rows of the consecutive batches are computed
+    for i, start in zip(range(0, len(x), 1000), [0, 5, 999]):
+
+        y = a.qdft(x[i:i+1000])[start::decimation]
+        z = qdft_decimated(b, x[i:i+1000], start, decimation)
+
+        assert y.shape == z.shape
+        assert numpy.allclose(y, z, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('confidence,duration,seconds', [
+    (None, None, 10),
+    (0.9,  None, 2),
+    (None, 2.5,  2.5),
+])
+def test_histogram(confidence: float, duration: float, seconds: float):
+
+    sr = 100
+
+    def batches():
+        for i in range(10):
+            yield numpy.full(sr, 442.2 - (i == 0)), numpy.ones(sr) * 0.1 ** (i == 0)
+
+    bins, hist, size = histogram(batches(), sr, confidence=confidence, duration=duration, warmup=2)
+
+    assert bins.tolist() == [441, 442]
+    assert bins[numpy.argmax(hist)] == 442
+    assert size == seconds
+
+
+@pytest.mark.parametrize('decimation', [1, 64])
+def test_analyze(tmp_path: Path, decimation: int):
+
+    a4 = 436
+    sr = 44100
+
+    t = numpy.arange(3 * sr) / sr
+    x = sum(numpy.sin(2 * numpy.pi * a4 * numpy.power(2, k / 12) * t) for k in [-9, -5, 0])
+
+    soundfile.write(tmp_path / 'test.wav', numpy.stack([x, x], axis=-1) / 4, sr)
+
+    estimates, weights = analyze(tmp_path / 'test.wav', RemucsOptions(decimation=decimation))
+
+    assert len(estimates) == int(numpy.ceil(3 * 8000 / decimation))
+
+    bins, hist, _ = histogram((batch for batch in [(estimates, weights)]), 8000 / decimation)
+
+    assert bins[numpy.argmax(hist)] == a4
+
+
+def test_reuse(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+
+    a4 = 436
+    sr = 44100
+
+    t = numpy.arange(3 * sr) / sr
+    x = sum(numpy.sin(2 * numpy.pi * a4 * numpy.power(2, k / 12) * t) for k in [-9, -5, 0])
+
+    src = tmp_path / 'other.wav'
+    soundfile.write(src, numpy.stack([x, x], axis=-1) / 4, sr)
+
+    runs     = []
+    original = tuning.estimate
+
+    def estimate(*args):
+        runs.append(args)
+        return original(*args)
+
+    monkeypatch.setattr(tuning, 'estimate', estimate)
+
+    opts = RemucsOptions(a4=440, decimation=64)
+
+    # the estimated tuning is kept next to the stem
+    assert howto_shift_pitch(src, opts) == pytest.approx(440 / a4)
+    assert (tmp_path / 'other.wav.tuning.json').is_file()
+    assert len(runs) == 1
+
+    # and reused with the same analysis parameters, but not with the target frequency
+    assert howto_shift_pitch(src, RemucsOptions(a4=442, decimation=64)) == pytest.approx(442 / a4)
+    assert len(runs) == 1
+
+    # whereas any other analysis parameter requires a new estimation
+    assert howto_shift_pitch(src, RemucsOptions(a4=440, decimation=32)) == pytest.approx(440 / a4)
+    assert len(runs) == 2
+
+    assert howto_shift_pitch(src, RemucsOptions(a4=440, decimation=64, dtype='float32')) == pytest.approx(440 / a4)
+    assert len(runs) == 3